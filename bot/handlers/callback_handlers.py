@@ -1,25 +1,115 @@
 import logging
-from telegram import Update
+from telegram import InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
+from telegram.constants import ChatMemberStatus
+from telegram.error import TelegramError
+
+from bot.utils import audit
+from bot.utils import database as db
+from bot.utils import outbox
+from bot.utils import phash
 
 logger = logging.getLogger(__name__)
 
+
+async def _is_chat_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
+    """Checks if a user is an administrator (or the owner) of a chat."""
+    try:
+        member = await context.bot.get_chat_member(chat_id, user_id)
+    except TelegramError as e:
+        logger.warning(f"Failed to check admin status of {user_id} in {chat_id}: {e}")
+        return False
+    return member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+
+def _log_decision(query, file_unique_id: str, action: str, chat_id: int | None = None) -> dict | None:
+    """
+    Looks up the logged verdict a notice button refers to and logs the admin's
+    or user's decision next to it. Returns the looked-up entry, or None.
+    """
+    if chat_id is None and query.message:
+        chat_id = query.message.chat.id
+    entry = audit.lookup(file_unique_id, chat_id)
+    if entry is None:
+        logger.warning(f"No logged verdict for {file_unique_id} in chat {chat_id}")
+        return None
+    audit.record(
+        entry["chat_id"],
+        query.from_user.id,
+        entry["message_id"],
+        file_unique_id,
+        entry["media_type"],
+        entry["verdict"],
+        entry["violations"],
+        action,
+        source="log",
+    )
+    return entry
+
+
+def _remaining_keyboard(query, file_unique_id: str) -> InlineKeyboardMarkup | None:
+    """
+    Returns the notice's keyboard without the buttons of the entry acted on, so
+    the other deletions of a merged notice can still be challenged or allowed.
+    """
+    markup = query.message.reply_markup
+    if markup is None:
+        return None
+    # challenge_<file_unique_id> and allow_<chat_id>_<file_unique_id>
+    acted_on = {f"challenge_{file_unique_id}", f"allow_{query.message.chat.id}_{file_unique_id}"}
+    rows = [row for row in markup.inline_keyboard if not any(button.callback_data in acted_on for button in row)]
+    return InlineKeyboardMarkup(rows) if rows else None
+
+
+async def _edit_notice(query, text: str, reply_markup: InlineKeyboardMarkup | None):
+    """Edits a notice after a button press and stops merging later deletions into it."""
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+    # The outbox would overwrite the edit; later deletions start a new notice
+    outbox.forget_notice(query.message.chat.id, query.message.message_id)
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Parses the CallbackQuery and updates the message text."""
     query = update.callback_query
     if not query or not query.data:
         return
-    
-    await query.answer() # Answer the callback to remove the "loading" state on the user's end.
 
     action = query.data.split("_")[0]
 
     if action == "challenge":
+        await query.answer() # Answer the callback to remove the "loading" state on the user's end.
         logger.info(f"User {query.from_user.id} 'Challenged' media {query.data}")
+        file_unique_id = query.data.split("_", 1)[1]
+        entry = _log_decision(query, file_unique_id, "challenged")
+        detail = f" Logged verdict: {audit.describe(entry)}." if entry else ""
         # We will add logic here to direct the user to the bot's PM
-        await query.edit_message_text(text=f"{query.message.text}\n\n✅ Challenge noted.")
+        await _edit_notice(
+            query, f"{query.message.text}\n\n✅ Challenge noted.{detail}", _remaining_keyboard(query, file_unique_id)
+        )
 
     elif action == "allow":
         logger.info(f"User {query.from_user.id} clicked 'Allow Exception' for {query.data}")
-        # We will add admin checks and database logic here
-        await query.edit_message_text(text=f"{query.message.text}\n\n⚠️ Admin action required.")
\ No newline at end of file
+        # file_unique_id may itself contain underscores
+        _, chat_id_str, file_unique_id = query.data.split("_", 2)
+        chat_id = int(chat_id_str)
+
+        if not await _is_chat_admin(context, chat_id, query.from_user.id):
+            await query.answer("Only chat admins can allow exceptions.", show_alert=True)
+            return
+
+        await query.answer()
+        if not db.add_media_exception(chat_id, file_unique_id):
+            # Keep the buttons, so the admin can try again
+            await _edit_notice(
+                query, f"{query.message.text}\n\n⚠️ Failed to save exception.", query.message.reply_markup
+            )
+            return
+
+        # Also cover visually identical re-uploads of the same media
+        phash.add_exception(chat_id, file_unique_id)
+        _log_decision(query, file_unique_id, "allowed", chat_id)
+        await _edit_notice(
+            query,
+            f"{query.message.text}\n\n✅ Exception allowed by {query.from_user.full_name}.",
+            _remaining_keyboard(query, file_unique_id),
+        )
@@ -1,9 +1,19 @@
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
-from telegram.constants import ChatMemberStatus
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.error import TelegramError
 
+import config
+from bot.utils import ai_models
 from bot.utils import database as db
+from bot.utils import cascade
+from bot.utils import outbox
+from bot.utils import phash
+from bot.utils import policy_profiles
+from bot.utils import remote_inference
+from bot.utils import scheduler
+from bot.utils import verdict_cache
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +46,182 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await message.reply_html(start_message)
 
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles the /stats command.
+    Reports runtime counters to the bot owner.
+    """
+    user = update.effective_user
+    message = update.effective_message
+    if not user or not message or user.id != config.BOT_OWNER_ID:
+        return
+
+    if remote_inference.is_enabled():
+        remote_stats = remote_inference.get_stats()
+        stats_message = "<b>Inference Workers</b>\n"
+        for worker in remote_stats["workers"]:
+            stats_message += (
+                f"<code>{worker['address']}</code>: "
+                f"{'ready' if worker['healthy'] else 'down'}, "
+                f"<code>{worker['in_flight']}</code> in flight\n"
+            )
+        stats_message += (
+            f"Requests: <code>{remote_stats['requests']}</code>, "
+            f"re-dispatched: <code>{remote_stats['redispatched']}</code>, "
+            f"unavailable: <code>{remote_stats['unavailable']}</code>\n\n"
+        )
+    else:
+        model_state = ai_models.readiness()
+        stats_message = f"<b>Model</b>\nState: <code>{model_state['state']}</code>\n"
+        if model_state["load_seconds"] is not None:
+            stats_message += (
+                f"Load time: <code>{model_state['load_seconds']:.1f}s</code>\n"
+                f"Ready after start: <code>{model_state['startup_seconds']:.1f}s</code>\n"
+            )
+        stats_message += f"Queued: <code>{ai_models.queue_depth()}</code>\n\n"
+
+    scheduler_stats = scheduler.get_stats()
+    stats_message += (
+        "<b>Moderation Scheduler</b>\n"
+        f"Queued: <code>{scheduler_stats['admin_group']}</code> admin groups, "
+        f"<code>{scheduler_stats['group']}</code> groups, "
+        f"<code>{scheduler_stats['private']}</code> private, "
+        f"<code>{scheduler_stats['deferred']}</code> deferred\n"
+        f"Running: <code>{scheduler_stats['running']}</code>"
+        f"{' (overloaded)' if scheduler_stats['overloaded'] else ''}\n"
+        f"Admitted: <code>{scheduler_stats['admitted']}</code>, "
+        f"shed: <code>{scheduler_stats['shed']}</code>, "
+        f"degraded: <code>{scheduler_stats['degraded']}</code>\n\n"
+    )
+
+    outbox_stats = outbox.get_stats()
+    stats_message += (
+        "<b>Outbox</b>\n"
+        f"Deleted: <code>{outbox_stats['deleted']}</code> in "
+        f"<code>{outbox_stats['delete_calls']}</code> calls\n"
+        f"Notices: <code>{outbox_stats['notices_sent']}</code> sent, "
+        f"<code>{outbox_stats['notices_edited']}</code> edits\n"
+        f"Pending: <code>{outbox_stats['pending_deletions']}</code>, "
+        f"scheduled: <code>{outbox_stats['scheduled_deletions']}</code>\n"
+        f"Flood waits: <code>{outbox_stats['retry_after']}</code>, "
+        f"failed: <code>{outbox_stats['failed']}</code>\n\n"
+    )
+
+    cache_stats = verdict_cache.get_stats()
+    stats_message += (
+        "<b>Verdict Cache</b>\n"
+        f"Memory hits: <code>{cache_stats['memory_hits']}</code>\n"
+        f"DB hits: <code>{cache_stats['db_hits']}</code>\n"
+        f"Misses: <code>{cache_stats['misses']}</code>\n"
+        f"Hit rate: <code>{cache_stats['hit_rate'] * 100:.1f}%</code>\n"
+        f"Memory size: <code>{cache_stats['memory_size']}/{config.CACHE_MAX_SIZE}</code>\n\n"
+    )
+    hash_stats = phash.get_stats()
+    stats_message += (
+        "<b>Near-Duplicate Index</b>\n"
+        f"Verdict reuses: <code>{hash_stats['near_duplicate_hits']}</code>\n"
+        f"Exception matches: <code>{hash_stats['exception_hits']}</code>\n"
+        f"Indexed: <code>{hash_stats['indexed_verdicts']}</code> verdicts, "
+        f"<code>{hash_stats['indexed_exceptions']}</code> exceptions\n\n"
+    )
+    cascade_stats = cascade.get_stats()
+    stats_message += (
+        "<b>Cascade Pre-Classifier</b>\n"
+        f"Decided safe: <code>{cascade_stats['decided_safe']}</code>\n"
+        f"Decided flagged: <code>{cascade_stats['decided_flagged']}</code>\n"
+        f"Escalated to VLM: <code>{cascade_stats['escalated']}</code> "
+        f"(<code>{cascade_stats['escalation_rate'] * 100:.1f}%</code>)\n\n"
+    )
+    policy_stats = ai_models.get_policy_stats()
+    stats_message += "<b>Early-Exit Policy Order</b>\n"
+    for key in ai_models.policy_order():
+        stats = policy_stats.get(key, {"evaluated": 0, "hits": 0})
+        stats_message += (
+            f"{key}: <code>{stats['hits']}/{stats['evaluated']}</code> hits\n"
+        )
+    await message.reply_html(stats_message)
+
+
+POLICY_USAGE = (
+    "<b>Usage</b>\n"
+    "/policy - show this chat's policies\n"
+    "/policy enable|disable &lt;policy&gt;\n"
+    "/policy threshold &lt;policy&gt; &lt;0.0-1.0&gt;\n"
+    "/policy video on|off - sample video frames, or judge videos by their thumbnail\n"
+    "/policy reset"
+)
+
+
+def _render_profile(profile: dict) -> str:
+    lines = ["<b>Policy Profile</b>"]
+    for key in config.DETECTION_POLICIES:
+        threshold = profile["policies"].get(key)
+        state = f"on, threshold <code>{threshold:.2f}</code>" if threshold is not None else "off"
+        lines.append(f"{policy_profiles.label(key)} (<code>{key.removeprefix('is_')}</code>): {state}")
+    lines.append(f"Video frame sampling: {'on' if profile['sample_video'] else 'off (thumbnails only)'}")
+    return "\n".join(lines)
+
+
+async def policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles the /policy command.
+    Shows or edits the chat's policy profile; changes are limited to chat admins.
+    """
+    user = update.effective_user
+    chat = update.effective_chat
+    message = update.effective_message
+    if not user or not chat or not message:
+        return
+
+    profile = policy_profiles.get_profile(chat.id)
+    args = [arg.lower() for arg in context.args or []]
+    if not args:
+        await message.reply_html(f"{_render_profile(profile)}\n\n{POLICY_USAGE}")
+        return
+
+    if chat.type != ChatType.PRIVATE:
+        try:
+            member = await context.bot.get_chat_member(chat.id, user.id)
+        except TelegramError as e:
+            logger.warning(f"Failed to check admin status of {user.id} in {chat.id}: {e}")
+            return
+        if member.status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+            await message.reply_text("Only chat admins can change the policy profile.")
+            return
+
+    def policy_key(name: str) -> str | None:
+        key = name if name.startswith("is_") else f"is_{name}"
+        return key if key in config.DETECTION_POLICIES else None
+
+    changed = {"policies": dict(profile["policies"]), "sample_video": profile["sample_video"]}
+    command, key = args[0], policy_key(args[1]) if len(args) > 1 else None
+    if command == "reset":
+        changed = policy_profiles.default_profile()
+    elif command in ("enable", "disable") and key:
+        if command == "enable":
+            changed["policies"].setdefault(key, config.POLICY_THRESHOLDS.get(key, 0.5))
+        else:
+            changed["policies"].pop(key, None)
+    elif command == "threshold" and key and len(args) == 3:
+        try:
+            threshold = float(args[2])
+        except ValueError:
+            threshold = -1.0
+        if not 0.0 <= threshold <= 1.0:
+            await message.reply_html(f"The threshold must be between 0.0 and 1.0.\n\n{POLICY_USAGE}")
+            return
+        changed["policies"][key] = threshold
+    elif command == "video" and len(args) == 2 and args[1] in ("on", "off"):
+        changed["sample_video"] = args[1] == "on"
+    else:
+        await message.reply_html(POLICY_USAGE)
+        return
+
+    policy_profiles.save_profile(chat.id, chat.type, changed)
+    logger.info(f"User {user.id} changed the policy profile of chat {chat.id}: {' '.join(args)}")
+    await message.reply_html(_render_profile(changed))
+
+
 async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Tracks when the bot is added to or removed from a group.
@@ -51,6 +237,7 @@ async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info(
         f"Bot status changed in chat {chat.id} ({chat.title}): {old_status} -> {new_status}"
     )
+    scheduler.set_admin(chat.id, new_status == ChatMemberStatus.ADMINISTRATOR)
 
     if new_status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR):
         # Bot was added or promoted
@@ -1,181 +1,460 @@
+import asyncio
+import io
 import logging
-import os
-import tempfile
-import uuid
-import ffmpeg  # type: ignore
+from typing import Any, Sequence
 
-from telegram import Update, File, InlineKeyboardButton, InlineKeyboardMarkup
+from PIL import Image
+
+from telegram import Chat, Message, Update, User, PhotoSize
 from telegram.ext import ContextTypes, ExtBot
-from telegram.constants import ChatType, ChatAction, ParseMode
-from telegram.error import TelegramError
+from telegram.constants import ChatType, ChatAction
 
 import config
 from bot.utils import database as db
 from bot.utils import ai_models
+from bot.utils import audit
+from bot.utils import metrics
+from bot.utils import outbox
+from bot.utils import phash
+from bot.utils import policy_profiles
+from bot.utils import preprocess
+from bot.utils import remote_inference
+from bot.utils import scheduler
+from bot.utils import video_frames
+from bot.utils import verdict_cache
 
 logger = logging.getLogger(__name__)
 
 
-async def _delete_message_after(context: ContextTypes.DEFAULT_TYPE):
-    """Callback job to delete a message."""
-    try:
-        await context.bot.delete_message(
-            chat_id=context.job.chat_id, message_id=context.job.data["message_id"]
-        )
-        logger.info(f"Auto-deleted warning message in chat {context.job.chat_id}")
-    except TelegramError as e:
-        logger.warning(
-            f"Failed to auto-delete warning message in {context.job.chat_id}: {e}"
-        )
+def _select_photo_size(sizes: Sequence[PhotoSize]) -> PhotoSize:
+    """Picks the smallest photo size that still covers the model input resolution."""
+    for size in sorted(sizes, key=lambda size: size.width * size.height):
+        if min(size.width, size.height) >= config.MODEL_INPUT_SIZE:
+            return size
+    return max(sizes, key=lambda size: size.width * size.height)
 
 
-async def _extract_frame(video_path: str, image_path: str) -> bool:
-    """Extracts a single frame from a video file."""
-    try:
-        (
-            ffmpeg.input(video_path, ss=1)
-            .output(image_path, vframes=1)
-            .overwrite_output()
-            .run(cmd="ffmpeg", capture_stdout=True, capture_stderr=True)
-        )
-        return os.path.exists(image_path)
-    except ffmpeg.Error as e:
-        logger.error(f"FFmpeg error: {e.stderr.decode() if e.stderr else str(e)}")
-        return False
+async def _download_media(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    chat_type: str,
+    file_id: str,
+    is_video: bool,
+    duration: float | None = None,
+    pixels: int | None = None,
+) -> list[bytes | Image.Image]:
+    """
+    Downloads a media file into memory, refusing files over DOWNLOAD_MAX_BYTES.
+    Images are returned as their encoded bytes, videos are decoded into sampled frames.
+    Returns an empty list if no image could be extracted.
+    """
+    with metrics.timed("get_file"):
+        file_to_process = await context.bot.get_file(file_id)
+    if (file_to_process.file_size or 0) > config.DOWNLOAD_MAX_BYTES:
+        logger.warning(f"Skipping download of {file_to_process.file_size} bytes (over the cap)")
+        return []
 
+    if is_video and chat_type == ChatType.PRIVATE:
+        await context.bot.send_chat_action(chat_id, ChatAction.UPLOAD_PHOTO)
 
-async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles incoming media (photos, stickers, videos, GIFs)."""
-    message = update.effective_message
-    chat = update.effective_chat
-    user = update.effective_user
-    if not message or not chat or not user:
-        return
+    buffer = io.BytesIO()
+    with metrics.timed("download"):
+        await file_to_process.download_to_memory(out=buffer)
+    content = buffer.getvalue()
+    if not content or len(content) > config.DOWNLOAD_MAX_BYTES:
+        return []
 
-    is_group = chat.type in (ChatType.GROUP, ChatType.SUPERGROUP)
-    file_to_process: File | None = None
+    if is_video:
+        with metrics.timed("ffmpeg"):
+            return await video_frames.extract_frames(content, duration, pixels)
+    return [content]
+
+
+async def _download_items(context: ContextTypes.DEFAULT_TYPE, chat: Chat, items: list[dict[str, Any]]):
+    """Downloads the items concurrently, storing their frames (empty if the download failed)."""
+    downloads = await asyncio.gather(
+        *(
+            _download_media(
+                context, chat.id, chat.type, item["file_id"], item["is_video"], item["duration"], item["pixels"]
+            )
+            for item in items
+        ),
+        return_exceptions=True,
+    )
+    for item, frames in zip(items, downloads):
+        if isinstance(frames, Exception):
+            logger.error(f"Download of {item['media_type']} {item['file_unique_id']} failed: {frames}")
+            frames = []
+        item["frames"] = frames
+
+
+async def _analyze_items(
+    items: list[dict[str, Any]], policies: dict[str, float], early_exit: bool, cascade_only: bool = False
+):
+    """
+    Analyzes the frames of all items (an album) in a single inference request,
+    for the chat's policies, and stores each item's aggregated result as its "analysis".
+    With INFERENCE_WORKERS, each item's frames go to the worker owning its file_unique_id.
+    """
+    if remote_inference.is_enabled():
+        item_results = await asyncio.gather(*(
+            asyncio.gather(*(
+                remote_inference.analyze(
+                    frame, item["file_unique_id"], early_exit=early_exit, cascade_only=cascade_only,
+                    policies=policies,
+                )
+                for frame in item["frames"]
+            ))
+            for item in items
+        ))
+    else:
+        frame_results = await ai_models.analyze_many_async(
+            [frame for item in items for frame in item["frames"]],
+            early_exit=early_exit,
+            cascade_only=cascade_only,
+            policies=policies,
+        )
+        item_results, offset = [], 0
+        for item in items:
+            item_results.append(frame_results[offset:offset + len(item["frames"])])
+            offset += len(item["frames"])
+    for item, results in zip(items, item_results):
+        item["analysis"] = video_frames.aggregate_frames(list(results), policies)
+
+
+def _select_media(message: Message) -> dict[str, Any] | None:
+    """Picks the file to judge for a message, or None if it has no usable media."""
+    file_id = ""
     media_type = "media"
     is_video = False
     file_unique_id = ""
+    duration = None
+    pixels = None
 
+    # file_unique_id always identifies the original media (cache keys, exceptions),
+    # while file_id may point at a smaller rendition that is enough for the model.
     if message.photo:
-        photo = message.photo[-1]
-        file_to_process = await context.bot.get_file(photo.file_id)
-        file_unique_id = photo.file_unique_id
+        file_id = _select_photo_size(message.photo).file_id
+        file_unique_id = message.photo[-1].file_unique_id
         media_type = "photo"
     elif message.sticker:
         sticker = message.sticker
-        file_to_process = await context.bot.get_file(sticker.file_id)
+        file_id = sticker.file_id
         file_unique_id = sticker.file_unique_id
         media_type = "sticker"
-        is_video = sticker.is_video or sticker.is_animated
+        is_video = sticker.is_video
+        if sticker.is_animated:
+            # Animated (Lottie) stickers cannot be decoded, use their preview
+            file_id = sticker.thumbnail.file_id if sticker.thumbnail else ""
     elif message.animation:
         animation = message.animation
-        file_to_process = await context.bot.get_file(animation.file_id)
+        file_id = animation.file_id
         file_unique_id = animation.file_unique_id
         media_type = "GIF"
         is_video = True
+        duration = animation.duration
+        pixels = animation.width * animation.height
     elif message.video:
         video = message.video
-        file_to_process = await context.bot.get_file(video.file_id)
+        file_id = video.file_id
         file_unique_id = video.file_unique_id
         media_type = "video"
         is_video = True
+        duration = video.duration
+        pixels = video.width * video.height
+
+    # Videos over the download cap are judged by their thumbnail
+    media = message.animation or message.video
+    if media and (media.file_size or 0) > config.DOWNLOAD_MAX_BYTES and media.thumbnail:
+        file_id = media.thumbnail.file_id
+        is_video = False
+    media = message.animation or message.video or message.sticker
+    thumbnail_id = media.thumbnail.file_id if is_video and media.thumbnail else None
 
-    if not file_to_process or not file_unique_id:
+    if not file_id or not file_unique_id:
+        return None
+    return {
+        "message": message,
+        "media_type": media_type,
+        "file_id": file_id,
+        "file_unique_id": file_unique_id,
+        "is_video": is_video,
+        "thumbnail_id": thumbnail_id,
+        "duration": duration,
+        "pixels": pixels,
+    }
+
+
+# Telegram albums hold at most this many items
+_ALBUM_MAX_ITEMS = 10
+
+# (chat_id, media_group_id) -> album being collected, see _collect_album
+_albums: dict[tuple[int, str], dict[str, Any]] = {}
+
+
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles incoming media (photos, stickers, videos, GIFs).
+    Only picks the file to judge; the moderation itself is queued in the scheduler.
+    Album items are collected first and moderated together.
+    """
+    message = update.effective_message
+    chat = update.effective_chat
+    user = update.effective_user
+    if not message or not chat or not user:
         return
 
-    # 1. Check for exceptions
-    if is_group and db.check_media_exception(chat.id, file_unique_id):
-        logger.info(f"Skipping whitelisted media {file_unique_id} in chat {chat.id}")
+    item = _select_media(message)
+    if item is None:
+        return
+    if message.media_group_id:
+        _collect_album(context, chat, user, message.media_group_id, item)
         return
+    await _submit(context, chat, user, [item])
 
-    # 2. Download and prepare for analysis
-    image_bytes = None
-    with tempfile.TemporaryDirectory() as temp_dir:
-        download_path = os.path.join(temp_dir, str(uuid.uuid4()))
-        await file_to_process.download_to_drive(custom_path=download_path)
-        if is_video:
-            if chat.type == ChatType.PRIVATE:
-                await context.bot.send_chat_action(chat.id, ChatAction.UPLOAD_PHOTO)
-            frame_path = os.path.join(temp_dir, f"{uuid.uuid4()}.jpg")
-            if await _extract_frame(download_path, frame_path):
-                with open(frame_path, "rb") as f:
-                    image_bytes = f.read()
-        else:
-            with open(download_path, "rb") as f:
-                image_bytes = f.read()
 
-    # 3. Analyze the image
-    if not image_bytes:
-        logger.warning(f"Could not extract bytes from {media_type} {file_unique_id}")
-        return
+def _collect_album(
+    context: ContextTypes.DEFAULT_TYPE, chat: Chat, user: User, media_group_id: str, item: dict[str, Any]
+):
+    """
+    Adds an item to its album. The first item starts a task that submits the
+    album once it is complete or ALBUM_COLLECT_SECONDS have passed.
+    """
+    key = (chat.id, media_group_id)
+    album = _albums.get(key)
+    if album is None:
+        album = _albums[key] = {"items": [], "complete": asyncio.Event()}
+        context.application.create_task(_submit_album(context, chat, user, key, album))
+    album["items"].append(item)
+    if len(album["items"]) >= _ALBUM_MAX_ITEMS:
+        album["complete"].set()
+
+
+async def _submit_album(
+    context: ContextTypes.DEFAULT_TYPE, chat: Chat, user: User, key: tuple[int, str], album: dict[str, Any]
+):
+    try:
+        await asyncio.wait_for(album["complete"].wait(), config.ALBUM_COLLECT_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    # Items arriving later start a new album
+    del _albums[key]
+    items = sorted(album["items"], key=lambda item: item["message"].message_id)
+    await _submit(context, chat, user, items)
+
+
+async def _submit(context: ContextTypes.DEFAULT_TYPE, chat: Chat, user: User, items: list[dict[str, Any]]):
+    """Queues the moderation of one media item or album in the scheduler."""
+    media_type = items[0]["media_type"] if len(items) == 1 else f"album of {len(items)}"
+    file_unique_id = items[0]["file_unique_id"]
+
+    async def run(degradations: frozenset[str]):
+        await _moderate_media(context, chat, user, items, degradations)
+
+    priority = await scheduler.chat_priority(context.bot, chat)
+    if not scheduler.submit(chat.id, priority, run, chat=chat.id, media=media_type, id=file_unique_id):
+        logger.warning(f"Moderation queue full, dropped {media_type} {file_unique_id} from chat {chat.id}")
+        for _ in items:
+            metrics.count("shed")
+
+
+def _audit(chat: Chat, user: User, item: dict[str, Any], action: str):
+    audit.record(
+        chat.id,
+        user.id,
+        item["message"].message_id,
+        item["file_unique_id"],
+        item["media_type"],
+        item["analysis"],
+        item.get("violations", []),
+        action,
+        source=item.get("source", "model"),
+    )
+
 
-    analysis = ai_models.analyze_image(image_bytes)
-    if "error" in analysis:
-        logger.error(f"Analysis failed for {media_type}: {analysis['error']}")
+def _reusable(analysis: dict[str, Any] | None, profile: dict[str, Any], is_group: bool) -> bool:
+    """Checks if a stored verdict can judge media for a chat, instead of a new analysis."""
+    if analysis is None:
+        return False
+    if analysis.get("partial") and not is_group:
+        # An early-exit verdict lacks the scores a private report needs
+        return False
+    return policy_profiles.evaluate(analysis, profile) is not None
+
+
+async def _moderate_media(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat: Chat,
+    user: User,
+    items: list[dict[str, Any]],
+    degradations: frozenset[str] = frozenset(),
+):
+    """
+    Judges one media item or an album against the chat's policy profile, then
+    deletes it (groups) or reports on it (private chats). An album is downloaded
+    concurrently, analyzed in a single inference request and acted on as a
+    unit: one flagged item removes all of it.
+    Under overload, `degradations` from the scheduler select cheaper analysis.
+    """
+    is_group = chat.type in (ChatType.GROUP, ChatType.SUPERGROUP)
+    album = items
+    profile = policy_profiles.get_profile(chat.id)
+    if not profile["policies"]:
+        logger.debug(f"All policies are disabled in chat {chat.id}")
         return
 
-    is_flagged = analysis.get("is_nsfw", False) or analysis.get("is_gore", False)
-
-    # 4. Take Action
-    if is_group and is_flagged:
-        reasons = []
-        if analysis.get("is_nsfw"):
-            reasons.append("NSFW")
-        if analysis.get("is_gore"):
-            reasons.append("Gore/Violence")
-        reasons_str = ", ".join(reasons)
-
-        try:
-            await message.delete()
-            logger.info(
-                f"Deleted flagged {media_type} ({reasons_str}) from {user.id} in chat {chat.id}"
-            )
+    # 1. Check for exceptions
+    if is_group:
+        allowed = []
+        for item in items:
+            if db.check_media_exception(chat.id, item["file_unique_id"]):
+                logger.info(f"Skipping whitelisted media {item['file_unique_id']} in chat {chat.id}")
+                metrics.count("excepted")
+            else:
+                allowed.append(item)
+        items = allowed
 
-            keyboard = [
-                [
-                    # We will add a URL to the log entry later
-                    # InlineKeyboardButton("View Log", url="https://t.me/your_log_channel"),
-                    InlineKeyboardButton(
-                        "🧐 Challenge", callback_data=f"challenge_{file_unique_id}"
-                    ),
-                    InlineKeyboardButton(
-                        "✅ Allow Exception",
-                        callback_data=f"allow_{chat.id}_{file_unique_id}",
-                    ),
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            notify_msg = await context.bot.send_message(
-                chat_id=chat.id,
-                text=f"Message from {user.mention_html()} deleted (Reason: {reasons_str}).",
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.HTML,
-            )
+    # 2. Reuse previous verdicts for the same files (skips download and inference)
+    misses = []
+    for item in items:
+        with metrics.timed("verdict_cache"):
+            analysis = verdict_cache.get_verdict(item["file_unique_id"])
+        if _reusable(analysis, profile, is_group):
+            if is_group and phash.is_excepted_file(chat.id, item["file_unique_id"]):
+                # An admin allowed a near-duplicate since this file was judged
+                logger.info(f"Skipping near-duplicate of whitelisted media in chat {chat.id}")
+                metrics.count("excepted")
+                continue
+            logger.debug(f"Verdict cache hit for {item['media_type']} {item['file_unique_id']}")
+            metrics.count("cache_hit")
+            item.update(analysis=analysis, source="cache")
+        else:
+            if item["is_video"] and item["thumbnail_id"] and not profile["sample_video"]:
+                # This chat judges videos by their thumbnail
+                item.update(file_id=item["thumbnail_id"], is_video=False, thumbnail=True)
+            misses.append(item)
+
+    if misses:
+        await _download_items(context, chat, misses)
+
+        # 2b. Match visually identical re-uploads against exceptions and old verdicts
+        to_analyze = []
+        for item in misses:
+            frames = item["frames"]
+            if not frames:
+                logger.warning(f"Could not extract bytes from {item['media_type']} {item['file_unique_id']}")
+                metrics.count("error")
+                continue
+            with metrics.timed("phash"):
+                image_hash = await preprocess.run_in_pool(phash.compute_hash, frames[len(frames) // 2])
+            if image_hash is not None and is_group and phash.is_excepted(chat.id, image_hash):
+                logger.info(f"Skipping near-duplicate of whitelisted media in chat {chat.id}")
+                metrics.count("excepted")
+                continue
+            item["image_hash"] = image_hash
+
+            analysis = phash.find_verdict(image_hash) if image_hash is not None else None
+            if _reusable(analysis, profile, is_group):
+                metrics.count("near_duplicate")
+                item.update(analysis=analysis, source="near_duplicate")
+                continue
+            if len(frames) > 1 and not profile["sample_video"]:
+                item["frames"] = [frames[len(frames) // 2]]
+                item["thumbnail"] = True
+            elif len(frames) > 1 and "single_frame" in degradations:
+                item["frames"] = [frames[len(frames) // 2]]
+                item["single_frame"] = True
+            to_analyze.append(item)
 
-            # Schedule the warning message for deletion
-            if config.WARNING_MSG_DELETE_SECONDS > 0:
-                context.job_queue.run_once(
-                    _delete_message_after,
-                    config.WARNING_MSG_DELETE_SECONDS,
-                    data={"message_id": notify_msg.message_id},
-                    chat_id=chat.id,
-                    name=f"delete_{chat.id}_{notify_msg.message_id}",
+        if to_analyze:
+            with metrics.timed("inference"):
+                await _analyze_items(
+                    to_analyze,
+                    profile["policies"],
+                    early_exit=is_group,
+                    cascade_only="cascade_only" in degradations,
                 )
+            for item in to_analyze:
+                if item.get("single_frame"):
+                    item["analysis"]["degraded"] = True
+                if item.get("thumbnail"):
+                    # Not a full verdict for chats that sample video frames
+                    item["analysis"]["thumbnail"] = True
 
-        except Exception as e:
-            logger.error(f"Failed during deletion/notification in {chat.id}: {e}")
+        with metrics.timed("sqlite"):
+            for item in misses:
+                if "analysis" not in item:
+                    continue
+                analysis = item["analysis"]
+                verdict_cache.store_verdict(item["file_unique_id"], analysis)
+                image_hash = item["image_hash"]
+                if image_hash is not None and "error" not in analysis and not analysis.get("degraded"):
+                    phash.add_verdict_hash(item["file_unique_id"], image_hash)
 
-    elif chat.type == ChatType.PRIVATE:
-        nsfw_score = analysis.get("general_nsfw_score", 0.0) * 100
-        gore_score = analysis.get("gore_violence_score", 0.0) * 100
+    judged = []
+    for item in items:
+        analysis = item.get("analysis")
+        if analysis is None:
+            continue
+        if "error" in analysis:
+            logger.error(f"Analysis failed for {item['media_type']}: {analysis['error']}")
+            metrics.count("error")
+            _audit(chat, user, item, "error")
+            continue
+        item["violations"] = policy_profiles.evaluate(analysis, profile) or []
+        metrics.count("flagged" if item["violations"] else "safe")
+        judged.append(item)
+    flagged = [item for item in judged if item["violations"]]
+    if is_group:
+        action = "deleted" if flagged else "kept"
+    else:
+        action = "reported"
+    for item in judged:
+        _audit(chat, user, item, action)
 
-        report = (
-            "<b>Analysis Report</b>\n"
-            f"General NSFW: <code>{nsfw_score:.1f}%</code>\n"
-            f"Gore/Violence: <code>{gore_score:.1f}%</code>\n\n"
-            f"<b>Status: {'&#9888;&#65039; FLAGGED' if is_flagged else '&#9989; SAFE'}</b>"
+    # 3. Take Action, after the chat's earlier media was acted on
+    await scheduler.wait_turn()
+    if is_group and flagged:
+        reasons_str = ", ".join(
+            policy_profiles.label(key)
+            for key in profile["policies"]
+            if any(key in item["violations"] for item in flagged)
         )
-        await message.reply_html(report)
\ No newline at end of file
+        if len(album) > 1:
+            reasons_str += f"; album of {len(album)}"
+
+        # Deletion and notice are sent by the outbox, batched and rate limited
+        for item in album:
+            outbox.delete(chat.id, item["message"].message_id)
+        # The buttons cover the first flagged item of an album
+        file_unique_id = flagged[0]["file_unique_id"]
+        outbox.notify_deletion(
+            chat.id,
+            user.mention_html(),
+            reasons_str,
+            [
+                # We will add a URL to the log entry later
+                ("🧐 Challenge", f"challenge_{file_unique_id}"),
+                ("✅ Allow Exception", f"allow_{chat.id}_{file_unique_id}"),
+            ],
+        )
+        logger.info(
+            f"Queued deletion of {len(album)} message(s) with flagged media ({reasons_str}) "
+            f"from {user.id} in chat {chat.id}"
+        )
+
+    elif chat.type == ChatType.PRIVATE and judged:
+        lines = ["<b>Analysis Report</b>"]
+        for number, item in enumerate(judged, start=1):
+            if len(judged) > 1:
+                lines.append(f"\n<b>#{number} ({item['media_type']})</b>")
+            scores = item["analysis"].get("scores", {})
+            for key in profile["policies"]:
+                # A degraded (pre-classifier only) verdict has no score for the other policies
+                score = f"{scores[key] * 100:.1f}%" if key in scores else "not evaluated"
+                lines.append(f"{policy_profiles.label(key)}: <code>{score}</code>")
+            if len(judged) > 1:
+                lines.append(f"Status: {'&#9888;&#65039; FLAGGED' if item['violations'] else '&#9989; SAFE'}")
+        lines.append(f"\n<b>Status: {'&#9888;&#65039; FLAGGED' if flagged else '&#9989; SAFE'}</b>")
+        with metrics.timed("send_message"):
+            await judged[0]["message"].reply_html("\n".join(lines))
@@ -1,12 +1,21 @@
+import asyncio
+import inspect
 import logging
 import os
-import io
+import queue
+import threading
+import time
+import numpy as np
 import torch
-from typing import Any
+from concurrent.futures import Future
+from typing import Any, Callable
 from PIL import Image
 from transformers import AutoProcessor, PaliGemmaForConditionalGeneration
 
 import config
+from bot.utils import cascade
+from bot.utils import metrics
+from bot.utils import preprocess
 
 logger = logging.getLogger(__name__)
 
@@ -15,33 +24,144 @@ model: PaliGemmaForConditionalGeneration | None = None
 processor: AutoProcessor | None = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Weight dtype per inference backend
+BACKEND_DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "int8-dynamic": torch.float32,
+    "compiled": torch.float32,
+}
 
-def load_models():
+# Token ids of each policy prompt (image placeholders + prompt), built once at load
+_policy_input_ids: dict[str, torch.Tensor] = {}
+# Vocabulary ids of the "yes"/"no" answer tokens read in scoring mode
+_answer_token_ids: dict[str, list[int]] = {}
+# Forward kwargs that limit the LM head to the last position (name varies by version)
+_last_logits_kwargs: dict[str, int] = {}
+
+# Running hit/cost statistics per policy, used to order early-exit evaluation
+_policy_stats: dict[str, dict[str, float]] = {}
+# Written by the inference thread, read by /stats on the event loop
+_policy_stats_lock = threading.Lock()
+POLICY_COST_SMOOTHING = 0.1
+
+# --- Inference worker: owns the model, fed through a bounded queue ---
+_request_queue: queue.Queue = queue.Queue(maxsize=config.INFERENCE_QUEUE_SIZE)
+_worker: threading.Thread | None = None
+
+# --- Readiness: resolved with True once the model is loaded, False if loading failed ---
+_ready: Future = Future()
+_process_started = time.monotonic()
+_readiness: dict[str, Any] = {"state": "not started", "load_seconds": None, "startup_seconds": None}
+
+
+def _configure_threads():
+    """Applies the intra-op/inter-op thread settings from the config."""
+    if config.TORCH_NUM_THREADS:
+        torch.set_num_threads(config.TORCH_NUM_THREADS)
+    if config.TORCH_NUM_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(config.TORCH_NUM_INTEROP_THREADS)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work has started
+            logger.warning("Inter-op thread count already fixed, keeping current setting.")
+    logger.info(
+        f"Torch threads: intra-op {torch.get_num_threads()}, "
+        f"inter-op {torch.get_num_interop_threads()}"
+    )
+
+
+def _apply_backend(backend: str):
+    """Quantizes and/or compiles the loaded model for the selected backend."""
+    global model
+
+    if backend == "int8-dynamic":
+        if device != "cpu":
+            logger.warning("int8-dynamic quantization is CPU-only, running unquantized.")
+        else:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+    elif backend == "compiled":
+        model = torch.compile(model, dynamic=True)
+
+
+def _warm_up():
+    """Runs one blank image through every policy so the first real request is not slowed down."""
+    started = time.perf_counter()
+    prepared = preprocess.prepare(Image.new("RGB", (config.MODEL_INPUT_SIZE, config.MODEL_INPUT_SIZE)))
+    rows = [(0, key) for key in config.DETECTION_POLICIES]
+    with torch.no_grad():
+        image_features = _encode_images([prepared.pixels])
+        prepared.release()
+        inputs_embeds, attention_mask = _build_policy_batch(image_features, rows)
+        _score_rows(inputs_embeds, attention_mask)
+    logger.info(f"Warm-up pass finished in {time.perf_counter() - started:.2f}s")
+
+
+def model_path() -> str:
+    """Returns the directory the download script saves the main VLM to."""
+    return os.path.join(config.LOCAL_MODELS_BASE_DIR, config.HF_MODEL_ID.replace("/", "_"))
+
+
+def snapshot_path(backend: str) -> str:
+    """
+    Returns the directory of the load-optimized snapshot for a backend: safetensors
+    shards already in the backend's weight dtype, plus the processor config.
     """
-    Loads the main VLM from the local cache.
+    dtype_name = str(BACKEND_DTYPES[backend]).replace("torch.", "")
+    return f"{model_path()}-snapshot-{dtype_name}"
+
+
+def load_models(backend: str | None = None):
+    """
+    Loads the main VLM from the local cache and prepares it for the selected
+    inference backend (INFERENCE_BACKEND unless given). A snapshot built by
+    `scripts/download.py --snapshot` is preferred: its safetensors shards are
+    memory-mapped and need no dtype conversion.
     Fails if the model is not found.
     """
     global model, processor
-    
+
+    backend = backend or config.INFERENCE_BACKEND
+    if backend not in BACKEND_DTYPES:
+        _set_ready(False)
+        raise SystemExit(f"Unknown inference backend '{backend}'. Exiting.")
+
+    _readiness["state"] = "loading"
+    started = time.monotonic()
     try:
-        model_id = config.HF_MODEL_ID
-        local_path = os.path.join(config.LOCAL_MODELS_BASE_DIR, model_id.replace("/", "_"))
-        
+        local_path = snapshot_path(backend)
+        if not os.path.isdir(local_path):
+            local_path = model_path()
+
         logger.info(f"Loading main VLM from: {local_path}")
         if not os.path.exists(local_path) or not os.listdir(local_path):
              raise OSError(f"Model directory not found or empty at {local_path}")
 
+        _configure_threads()
         processor = AutoProcessor.from_pretrained(local_path)
+        preprocess.configure(processor.image_processor)
         model = PaliGemmaForConditionalGeneration.from_pretrained(
             local_path, 
-            torch_dtype=torch.bfloat16,
+            torch_dtype=BACKEND_DTYPES[backend],
             device_map=device,
-            revision="bfloat16",
+            low_cpu_mem_usage=True,
         ).eval()
 
-        logger.info(f"Main VLM loaded successfully on device: {device}")
+        # Inspects the forward signature, so it must run before compilation
+        _prepare_policy_inputs()
+        _apply_backend(backend)
+        if config.INFERENCE_WARMUP:
+            _warm_up()
+
+        logger.info(f"Main VLM loaded successfully on device: {device} (backend: {backend})")
+        if config.CASCADE_ENABLED:
+            cascade.load_classifier()
+        start_inference_worker()
 
     except Exception as e:
+        _set_ready(False)
         logger.critical(
             f"Model not found or failed to load. "
             f"Please run the download script first: python3 scripts/download.py",
@@ -49,46 +169,562 @@ def load_models():
         )
         raise SystemExit("Essential models not found. Exiting.")
 
+    _readiness["load_seconds"] = time.monotonic() - started
+    _set_ready(True)
+
+
+def _set_ready(ready: bool):
+    """Records the outcome of model loading and releases waiting requests."""
+    _readiness["state"] = "ready" if ready else "failed"
+    metrics.MODEL_READY.set(1 if ready else 0)
+    _readiness["startup_seconds"] = time.monotonic() - _process_started
+    if not _ready.done():
+        _ready.set_result(ready)
+    if ready:
+        logger.info(
+            f"Model ready: loaded in {_readiness['load_seconds']:.1f}s, "
+            f"{_readiness['startup_seconds']:.1f}s after process start"
+        )
+
+
+def start_loading(on_failure: Callable[[], None] | None = None):
+    """
+    Loads the models on a background thread so the bot can start polling at once.
+    Media arriving meanwhile waits in the inference queue until the model is ready.
+    If loading fails, waiting and later requests fail with "Model not loaded" and
+    `on_failure` is called (on the loader thread), e.g. to stop the bot.
+    """
+    def load():
+        try:
+            load_models()
+        except SystemExit as e:
+            logger.critical(f"Model loading failed, no media can be analyzed: {e}")
+            if on_failure:
+                on_failure()
+
+    threading.Thread(target=load, name="model-loader", daemon=True).start()
+
+
+def readiness() -> dict[str, Any]:
+    """Returns the loading state ("not started", "loading", "ready", "failed") and timings."""
+    return dict(_readiness)
+
+
+def analyze_image(
+    image_content: bytes | Image.Image,
+    early_exit: bool = False,
+    cascade_only: bool = False,
+    policies: dict[str, float] | None = None,
+) -> dict[str, Any]:
+    """
+    Analyzes image content using policies from the config.
+    Returns a dictionary with detection flags and per-policy scores.
+    With early_exit, evaluation stops at the first violating policy.
+    With cascade_only, the pre-classifier alone decides (see analyze_batch).
+    `policies` limits evaluation to some policies, at the given thresholds.
+    """
+    return analyze_batch(
+        [image_content], early_exit=[early_exit], cascade_only=[cascade_only], policies=[policies]
+    )[0]
+
+
+def _prepare_policy_inputs():
+    """
+    Tokenizes every policy prompt once. The prompt layout mirrors the PaliGemma
+    processor: image placeholder tokens, BOS, the prompt and a newline.
+    """
+    tokenizer = processor.tokenizer
+    image_token = getattr(processor, "image_token", "<image>")
+    image_seq_length = getattr(
+        processor, "image_seq_length", model.config.text_config.num_image_tokens
+    )
+
+    _policy_input_ids.clear()
+    for key, prompt in config.DETECTION_POLICIES.items():
+        text = f"{image_token * image_seq_length}{tokenizer.bos_token}{prompt}\n"
+        _policy_input_ids[key] = tokenizer(
+            text, add_special_tokens=False, return_tensors="pt"
+        )["input_ids"][0]
+
+    _answer_token_ids.clear()
+    for answer in ("yes", "no"):
+        _answer_token_ids[answer] = sorted({
+            tokenizer.encode(variant, add_special_tokens=False)[0]
+            for variant in (answer, answer.capitalize())
+        })
+
+    _last_logits_kwargs.clear()
+    forward_params = inspect.signature(model.forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in forward_params:
+            _last_logits_kwargs[name] = 1
+            break
+
+
+def _encode_images(pixels: list[np.ndarray]) -> torch.Tensor:
+    """Runs the vision tower and projector once per image, on preprocessed pixels."""
+    pixel_values = torch.from_numpy(np.stack(pixels)).to(device, dtype=model.dtype)
+    if hasattr(model, "get_image_features"):
+        return model.get_image_features(pixel_values)
+
+    # Older transformers releases: same computation as PaliGemma's forward pass
+    vision_outputs = model.vision_tower(pixel_values).last_hidden_state
+    image_features = model.multi_modal_projector(vision_outputs)
+    return image_features / (model.config.text_config.hidden_size**0.5)
+
+
+def _build_policy_batch(
+    image_features: torch.Tensor, rows: list[tuple[int, str]]
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Builds left-padded input embeddings for (image row, policy) pairs, splicing
+    the precomputed image features into the image placeholder positions.
+    Returns (inputs_embeds, attention_mask).
+    """
+    pad_token_id = processor.tokenizer.pad_token_id
+    max_length = max(len(_policy_input_ids[key]) for _, key in rows)
+
+    input_ids = torch.full((len(rows), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), max_length), dtype=torch.long)
+    for row, (_, key) in enumerate(rows):
+        ids = _policy_input_ids[key]
+        input_ids[row, max_length - len(ids):] = ids
+        attention_mask[row, max_length - len(ids):] = 1
+    input_ids = input_ids.to(device)
+
+    inputs_embeds = model.get_input_embeddings()(input_ids)
+    image_mask = (input_ids == model.config.image_token_index).unsqueeze(-1)
+    row_features = image_features[[image_row for image_row, _ in rows]].to(inputs_embeds.dtype)
+    inputs_embeds = inputs_embeds.masked_scatter(image_mask.expand_as(inputs_embeds), row_features)
+    return inputs_embeds, attention_mask.to(device)
+
+
+def _score_rows(inputs_embeds: torch.Tensor, attention_mask: torch.Tensor) -> list[float]:
+    """
+    Runs a single forward pass and reads the next-token logits of the answer.
+    Returns P(yes) against P(no) for every row.
+    """
+    # Left padding: real tokens are numbered from 1, as in PaliGemma's forward pass
+    position_ids = attention_mask.cumsum(-1)
+    outputs = model(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        use_cache=False,
+        **_last_logits_kwargs,
+    )
+    logits = outputs.logits[:, -1, :].float()
+    answer_logits = torch.stack(
+        [
+            torch.logsumexp(logits[:, _answer_token_ids["yes"]], dim=-1),
+            torch.logsumexp(logits[:, _answer_token_ids["no"]], dim=-1),
+        ],
+        dim=-1,
+    )
+    return torch.softmax(answer_logits, dim=-1)[:, 0].tolist()
+
+
+def _generate_rows(
+    inputs_embeds: torch.Tensor, attention_mask: torch.Tensor, rows: list[tuple[int, str]]
+) -> list[float]:
+    """
+    Decodes a free-text answer per row and matches it against VIOLATION_KEYWORDS.
+    Returns 1.0 for a violation and 0.0 otherwise.
+    """
+    # With only embeddings as input, generate returns just the new tokens
+    output = model.generate(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        max_new_tokens=20,
+    )
+    answers = processor.batch_decode(output, skip_special_tokens=True)
+
+    scores = []
+    for (_, key), answer in zip(rows, answers):
+        answer = answer.lower().strip()
+        prompt = config.DETECTION_POLICIES[key]
+        logger.debug(f"Policy: '{key}' | Prompt: '{prompt}' | VLM Answer: '{answer}'")
+
+        # Check if any violation keyword is in the model's answer
+        violation = any(keyword in answer for keyword in config.VIOLATION_KEYWORDS)
+        scores.append(1.0 if violation else 0.0)
+    return scores
+
+
+def _apply_cascade(
+    images: list[tuple[int, preprocess.PreparedImage]],
+    results: list[dict[str, Any]],
+    early_exit: list[bool],
+    cascade_only: list[bool],
+    policies: list[dict[str, float]],
+) -> list[tuple[int, preprocess.PreparedImage]]:
+    """
+    Runs the CPU pre-classifier, which settles is_nsfw for the images it is
+    confident about. Such an image is done if is_nsfw is its only policy, or if
+    it was flagged with early exit; otherwise it still needs the VLM for its
+    other policies. Images with cascade_only set are decided by the
+    pre-classifier even in the uncertain band, against the is_nsfw threshold,
+    and marked as degraded; their other policies are left unscored.
+    Images whose policies do not include is_nsfw skip the pre-classifier.
+    Returns the images that still need the VLM.
+    """
+    escalated = [(index, image) for index, image in images if "is_nsfw" not in policies[index]]
+    images = [(index, image) for index, image in images if "is_nsfw" in policies[index]]
+    if not images:
+        return escalated
+    try:
+        probabilities = cascade.score([prepared.image for _, prepared in images])
+    except Exception as e:
+        logger.error(f"Cascade pre-classifier failed, escalating batch: {e}", exc_info=True)
+        return escalated + images
+
+    for (index, image), probability in zip(images, probabilities):
+        decision = cascade.decide(probability)
+        degraded = decision is None and cascade_only[index]
+        if degraded:
+            decision = probability >= policies[index]["is_nsfw"]
+        elif decision is None:
+            escalated.append((index, image))
+            continue
+        result = results[index]
+        result["is_nsfw"] = decision
+        result["scores"] = {"is_nsfw": probability}
+        result["general_nsfw_score"] = probability
+        others = len(policies[index]) > 1
+        if others and not degraded and not (decision and early_exit[index]):
+            # is_nsfw is settled, the VLM scores the remaining policies
+            escalated.append((index, image))
+            continue
+        result["decided_by"] = "cascade"
+        if degraded:
+            result["degraded"] = True
+        if others and decision:
+            # Early exit: the remaining policies are skipped
+            result["partial"] = True
+    return escalated
+
+
+def policy_order() -> list[str]:
+    """
+    Returns the policies ordered for early-exit evaluation: the highest
+    (smoothed) hit rate per second of evaluation cost comes first.
+    """
+    policy_stats = get_policy_stats()
+
+    def priority(key: str) -> float:
+        stats = policy_stats.get(key)
+        if not stats:
+            return 0.5
+        hit_rate = (stats["hits"] + 1) / (stats["evaluated"] + 2)
+        return hit_rate / max(stats["cost"], 1e-6)
+
+    return sorted(config.DETECTION_POLICIES, key=priority, reverse=True)
 
-def analyze_image(image_content: bytes) -> dict[str, Any]:
+
+def _record_policy_stats(rows: list[tuple[int, str]], flags: list[bool], seconds: float):
+    """Updates the running hit rate and per-row cost of each evaluated policy."""
+    row_cost = seconds / len(rows)
+    with _policy_stats_lock:
+        for (_, key), flagged in zip(rows, flags):
+            stats = _policy_stats.setdefault(key, {"evaluated": 0, "hits": 0, "cost": row_cost})
+            stats["evaluated"] += 1
+            stats["hits"] += int(flagged)
+            stats["cost"] += POLICY_COST_SMOOTHING * (row_cost - stats["cost"])
+
+
+def get_policy_stats() -> dict[str, dict[str, float]]:
+    """Returns a consistent copy of the per-policy evaluation statistics."""
+    with _policy_stats_lock:
+        return {key: dict(stats) for key, stats in _policy_stats.items()}
+
+
+def analyze_batch(
+    image_contents: list[bytes | Image.Image],
+    early_exit: list[bool] | None = None,
+    cascade_only: list[bool] | None = None,
+    policies: list[dict[str, float] | None] | None = None,
+) -> list[dict[str, Any]]:
     """
-    Performs generative analysis on image content using policies from the config.
-    Returns a dictionary with detection flags.
+    Analyzes several images (encoded bytes, decoded frames or images already
+    prepared by the preprocess module) at once. If the cascade is enabled, the
+    CPU pre-classifier settles is_nsfw for the images it is confident about;
+    the VLM evaluates their other policies, if any. Each image that reaches the
+    VLM goes through the vision tower once; its features are then shared by
+    one row per policy.
+
+    Images with early_exit set only need a delete/keep decision: their policies
+    are evaluated one per round, in policy_order(), and evaluation stops at the
+    first violation. All other images get every policy in the first round.
+    Images with cascade_only set never reach the VLM while the cascade is
+    enabled (a cheaper, degraded verdict used under overload).
+    `policies` gives each image the policies to evaluate and their thresholds
+    (a chat's profile); None means every configured policy.
+    Returns one result dictionary per image, in order.
     """
     if not model or not processor:
         logger.error("AI model is not loaded. Skipping analysis.")
-        return {"error": "Model not loaded"}
+        return [{"error": "Model not loaded"} for _ in image_contents]
+
+    if early_exit is None:
+        early_exit = [False] * len(image_contents)
+    if cascade_only is None:
+        cascade_only = [False] * len(image_contents)
+    default_policies = {key: config.POLICY_THRESHOLDS.get(key, 0.5) for key in config.DETECTION_POLICIES}
+    policies = [
+        image_policies if image_policies is not None else default_policies
+        for image_policies in (policies or [None] * len(image_contents))
+    ]
+
+    results: list[dict[str, Any]] = []
+    images: list[tuple[int, preprocess.PreparedImage]] = []
+    with metrics.timed("decode"):
+        for image_content in image_contents:
+            if isinstance(image_content, preprocess.PreparedImage):
+                prepared = image_content
+            else:
+                try:
+                    prepared = preprocess.prepare(image_content)
+                except Exception as e:
+                    logger.error(f"Failed to open image from bytes: {e}")
+                    results.append({"error": "Invalid image content"})
+                    continue
+            results.append({key: False for key in policies[len(results)]})
+            images.append((len(results) - 1, prepared))
 
     try:
-        image = Image.open(io.BytesIO(image_content)).convert("RGB")
-    except Exception as e:
-        logger.error(f"Failed to open image from bytes: {e}")
-        return {"error": "Invalid image content"}
+        _evaluate(images, results, early_exit, cascade_only, policies)
+    finally:
+        for _, prepared in images:
+            prepared.release()
+    return results
+
+
+def _evaluate(
+    images: list[tuple[int, preprocess.PreparedImage]],
+    results: list[dict[str, Any]],
+    early_exit: list[bool],
+    cascade_only: list[bool],
+    policies: list[dict[str, float]],
+):
+    """
+    Runs the cascade and the VLM on prepared images, filling in their results.
+    The VLM runs on at most INFERENCE_MAX_BATCH_SIZE images at a time, so a
+    large album does not make one oversized forward pass.
+    """
+    if images and cascade.is_enabled():
+        with metrics.timed("cascade"):
+            images = _apply_cascade(images, results, early_exit, cascade_only, policies)
+
+    size = config.INFERENCE_MAX_BATCH_SIZE
+    for start in range(0, len(images), size):
+        _run_vlm(images[start:start + size], results, early_exit, policies)
+
 
-    results: dict[str, Any] = {
-        "is_nsfw": False,
-        "is_violence": False,
-        "is_drugs": False,
-    }
+def _run_vlm(
+    images: list[tuple[int, preprocess.PreparedImage]],
+    results: list[dict[str, Any]],
+    early_exit: list[bool],
+    policies: list[dict[str, float]],
+):
+    """Evaluates the remaining policies of some images with the VLM, in one vision encoder pass."""
+    # Policies still to evaluate (not settled by the cascade), per row in image_features
+    order = policy_order()
+    pending = {}
+    for image_row, (index, _) in enumerate(images):
+        settled = results[index].get("scores", {})
+        pending[image_row] = [key for key in order if key in policies[index] and key not in settled]
+    pending = {image_row: keys for image_row, keys in pending.items() if keys}
 
     try:
-        for key, prompt in config.DETECTION_POLICIES.items():
-            inputs = processor(text=prompt, images=image, return_tensors="pt").to(device)
-            
-            with torch.no_grad():
-                output = model.generate(**inputs, max_new_tokens=20)
-            
-            response_text = processor.decode(output[0], skip_special_tokens=True).lower()
-            # Remove the prompt from the response to get only the answer
-            answer = response_text.replace(prompt.lower(), "").strip()
-
-            logger.debug(f"Policy: '{key}' | Prompt: '{prompt}' | VLM Answer: '{answer}'")
-
-            # Check if any violation keyword is in the model's answer
-            if any(keyword in answer for keyword in config.VIOLATION_KEYWORDS):
-                results[key] = True
+        with torch.no_grad():
+            with metrics.timed("vision_encoder"):
+                image_features = _encode_images([prepared.pixels for _, prepared in images])
+
+            while pending:
+                rows = []
+                for image_row, keys in pending.items():
+                    if early_exit[images[image_row][0]]:
+                        rows.append((image_row, keys.pop(0)))
+                    else:
+                        rows.extend((image_row, key) for key in keys)
+                        keys.clear()
+
+                started = time.perf_counter()
+                with metrics.timed(f"policy_{config.ANALYSIS_MODE}"):
+                    inputs_embeds, attention_mask = _build_policy_batch(image_features, rows)
+                    if config.ANALYSIS_MODE == "generate":
+                        scores = _generate_rows(inputs_embeds, attention_mask, rows)
+                    else:
+                        scores = _score_rows(inputs_embeds, attention_mask)
+
+                flags = []
+                for (image_row, key), score in zip(rows, scores):
+                    index = images[image_row][0]
+                    result = results[index]
+                    result.setdefault("scores", {})[key] = score
+                    result[key] = score >= policies[index][key]
+                    flags.append(result[key])
+                    if result[key] and pending[image_row]:
+                        # Early exit: the remaining policies are skipped
+                        result["partial"] = True
+                        pending[image_row].clear()
+                _record_policy_stats(rows, flags, time.perf_counter() - started)
+
+                pending = {image_row: keys for image_row, keys in pending.items() if keys}
+
+        for index, _ in images:
+            result = results[index]
+            result.setdefault("scores", {})
+            result["general_nsfw_score"] = result["scores"].get("is_nsfw", 0.0)
+            result["gore_violence_score"] = result["scores"].get("is_violence", 0.0)
 
     except Exception as e:
         logger.error(f"Image analysis failed: {e}", exc_info=True)
+        for index, _ in images:
+            results[index]["error"] = "Inference failed"
+
+
+def _next_batch() -> list[tuple[list[preprocess.PreparedImage], bool, bool, dict[str, float] | None, Future]]:
+    """
+    Blocks for the first queued request, then keeps collecting requests until
+    the batch holds INFERENCE_MAX_BATCH_SIZE images or INFERENCE_MAX_WAIT_MS
+    has passed since the first one. A request of several images (an album) is
+    never split, so it may exceed the batch size on its own; _evaluate then
+    runs the VLM on it in chunks.
+    """
+    batch = [_request_queue.get()]
+    images = len(batch[0][0])
+    deadline = time.monotonic() + config.INFERENCE_MAX_WAIT_MS / 1000
+    while images < config.INFERENCE_MAX_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_request_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+        images += len(batch[-1][0])
+    return batch
+
+
+def _inference_loop():
+    """Runs queued analysis requests in micro-batches on the worker thread."""
+    while True:
+        # Skip requests whose caller already timed out or was cancelled
+        batch = []
+        for request in _next_batch():
+            if request[-1].set_running_or_notify_cancel():
+                batch.append(request)
+            else:
+                for prepared in request[0]:
+                    prepared.release()
+        if not batch:
+            continue
+
+        def per_image(field: int) -> list:
+            return [request[field] for request in batch for _ in request[0]]
+
+        contents = [image_content for image_contents, *_ in batch for image_content in image_contents]
+        metrics.INFERENCE_BATCH_SIZE.observe(len(contents))
+        try:
+            results = analyze_batch(
+                contents, early_exit=per_image(1), cascade_only=per_image(2), policies=per_image(3)
+            )
+        except Exception as e:
+            for *_, future in batch:
+                future.set_exception(e)
+            continue
+        offset = 0
+        for image_contents, *_, future in batch:
+            future.set_result(results[offset:offset + len(image_contents)])
+            offset += len(image_contents)
+
+
+def start_inference_worker():
+    """Starts the dedicated inference thread (idempotent)."""
+    global _worker
+    if _worker and _worker.is_alive():
+        return
+    _worker = threading.Thread(target=_inference_loop, name="inference-worker", daemon=True)
+    _worker.start()
+    logger.info("Inference worker started.")
+
+
+def queue_depth() -> int:
+    """Returns the number of requests waiting for the inference worker."""
+    return _request_queue.qsize()
+
+
+metrics.INFERENCE_QUEUE_DEPTH.set_function(queue_depth)
+
+
+async def analyze_async(
+    image_content: bytes | Image.Image,
+    early_exit: bool = False,
+    timeout: float | None = None,
+    cascade_only: bool = False,
+    policies: dict[str, float] | None = None,
+) -> dict[str, Any]:
+    """
+    Runs analyze_image on the inference worker without blocking the event loop.
+    Returns an error result if the queue is full, the model does not become
+    ready within MODEL_READY_TIMEOUT_SECONDS, or the request times out.
+    Cancelling the caller drops the request if it has not started yet.
+    `policies` limits the policies evaluated, as in analyze_image.
+    """
+    return (await analyze_many_async([image_content], early_exit, timeout, cascade_only, policies))[0]
+
+
+async def analyze_many_async(
+    image_contents: list[bytes | Image.Image],
+    early_exit: bool = False,
+    timeout: float | None = None,
+    cascade_only: bool = False,
+    policies: dict[str, float] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Like analyze_async, for several images (e.g. an album) that are queued as
+    one request and analyzed together in a single batch. Returns one result
+    per image, in order.
+    """
+    if timeout is None:
+        timeout = config.INFERENCE_TIMEOUT_SECONDS
+
+    def errors(message: str) -> list[dict[str, Any]]:
+        return [{"error": message} for _ in image_contents]
+
+    # While the model is loading the request waits here, before any work is done
+    if not _ready.done():
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(_ready)), config.MODEL_READY_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Model is still loading. Dropping request.")
+            return errors("Model not ready")
+    if not _ready.result():
+        return errors("Model not loaded")
+
+    # Decoding and normalization run on the preprocessing threads, so the
+    # inference worker only receives ready pixel buffers
+    with metrics.timed("preprocess"):
+        prepared = await preprocess.prepare_many(image_contents)
+    ready = [item for item in prepared if item is not None]
+    results: list[dict[str, Any]] = []
+    if ready:
+        future: Future = Future()
+        try:
+            _request_queue.put_nowait((ready, early_exit, cascade_only, policies, future))
+        except queue.Full:
+            logger.warning("Inference queue is full. Dropping request.")
+            for item in ready:
+                item.release()
+            return errors("Inference queue full")
+        try:
+            results = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Inference request timed out after {timeout}s")
+            return errors("Inference timed out")
 
-    return results
\ No newline at end of file
+    batch_results = iter(results)
+    return [next(batch_results) if item is not None else {"error": "Invalid image content"} for item in prepared]
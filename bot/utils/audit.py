@@ -0,0 +1,162 @@
+import asyncio
+import html
+import json
+import logging
+import time
+from typing import Any
+
+from telegram import Bot
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
+
+import config
+from bot.utils import database as db
+from bot.utils import metrics
+from bot.utils import policy_profiles
+from bot.utils import verdict_cache
+
+logger = logging.getLogger(__name__)
+
+# Actions worth a line in the log channel digest; the others are only counted
+DIGEST_ACTIONS = ("deleted", "error", "challenged", "allowed")
+
+_bot: Bot | None = None
+_task: asyncio.Task | None = None
+
+# Events since the last digest: action -> count, and the notable ones in order
+_counts: dict[str, int] = {}
+_events: list[dict[str, Any]] = []
+
+
+def record(
+    chat_id: int,
+    user_id: int | None,
+    message_id: int | None,
+    file_unique_id: str,
+    media_type: str,
+    analysis: dict[str, Any],
+    violations: list[str],
+    action: str,
+    source: str = "model",
+):
+    """
+    Appends a moderation decision to the verdict log, with the stage timings of
+    the current media item. The write is queued for the database writer thread.
+    """
+    _counts[action] = _counts.get(action, 0) + 1
+    if action in DIGEST_ACTIONS:
+        _events.append({
+            "chat_id": chat_id,
+            "file_unique_id": file_unique_id,
+            "media_type": media_type,
+            "violations": violations,
+            "scores": analysis.get("scores", {}),
+            "error": analysis.get("error"),
+            "action": action,
+        })
+        # The digest only shows the latest lines
+        del _events[:-config.AUDIT_DIGEST_MAX_LINES]
+    if not config.AUDIT_ENABLED:
+        return
+
+    timings = {stage: round(seconds * 1000, 2) for stage, seconds in metrics.stage_timings().items()}
+    db.add_verdict_record({
+        "created_at": int(time.time()),
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "message_id": message_id,
+        "file_unique_id": file_unique_id,
+        "media_type": media_type,
+        "source": source,
+        "model": f"{config.HF_MODEL_ID}@{config.INFERENCE_BACKEND}",
+        "policy_version": verdict_cache.policy_version(),
+        "verdict": json.dumps(analysis, separators=(",", ":")),
+        "violations": json.dumps(violations),
+        "timings": json.dumps(timings, separators=(",", ":")),
+        "action": action,
+    })
+
+
+def lookup(file_unique_id: str, chat_id: int | None = None) -> dict[str, Any] | None:
+    """Returns the latest logged decision for a file (in a chat), with its JSON fields decoded."""
+    row = db.get_verdict_record(file_unique_id, chat_id)
+    if row is None:
+        return None
+    for field in ("verdict", "violations", "timings"):
+        row[field] = json.loads(row[field])
+    return row
+
+
+def describe(entry: dict[str, Any]) -> str:
+    """Summarizes a logged verdict as 'NSFW 93%, Gore/Violence 4%'."""
+    scores = entry["verdict"].get("scores", {})
+    parts = [f"{policy_profiles.label(key)} {score * 100:.0f}%" for key, score in scores.items()]
+    return ", ".join(parts) or "no scores"
+
+
+def _render_digest(counts: dict[str, int], events: list[dict[str, Any]]) -> str:
+    minutes = config.AUDIT_DIGEST_INTERVAL_SECONDS / 60
+    totals = ", ".join(f"{action}: <code>{number}</code>" for action, number in sorted(counts.items()))
+    lines = [f"<b>Moderation digest</b> (last {minutes:g} min)", totals]
+    shown = sum(counts.get(action, 0) for action in DIGEST_ACTIONS)
+    if shown > len(events):
+        lines.append(f"… {shown - len(events)} earlier events")
+    for event in events:
+        if event["error"]:
+            detail = html.escape(event["error"])
+        elif event["violations"]:
+            detail = ", ".join(
+                f"{policy_profiles.label(key)} {event['scores'].get(key, 0.0) * 100:.0f}%"
+                for key in event["violations"]
+            )
+        else:
+            detail = "safe"
+        lines.append(
+            f"{event['action']} · <code>{event['chat_id']}</code> · {event['media_type']} "
+            f"<code>{html.escape(event['file_unique_id'])}</code> · {detail}"
+        )
+    return "\n".join(lines)
+
+
+async def _send_digest():
+    """Sends the events since the last digest to LOG_CHANNEL_ID, if any of them are notable."""
+    global _counts, _events
+    if not any(_counts.get(action) for action in DIGEST_ACTIONS):
+        return
+    counts, events = _counts, _events
+    _counts, _events = {}, []
+    try:
+        await _bot.send_message(config.LOG_CHANNEL_ID, _render_digest(counts, events), parse_mode=ParseMode.HTML)
+    except RetryAfter:
+        # Merge back into the next digest
+        for action, number in counts.items():
+            _counts[action] = _counts.get(action, 0) + number
+        _events = (events + _events)[-config.AUDIT_DIGEST_MAX_LINES:]
+        logger.warning("Flood limit while sending the moderation digest, retrying with the next one")
+    except TelegramError as e:
+        logger.error(f"Failed to send the moderation digest to {config.LOG_CHANNEL_ID}: {e}")
+
+
+async def _run():
+    while True:
+        await asyncio.sleep(config.AUDIT_DIGEST_INTERVAL_SECONDS)
+        await _send_digest()
+
+
+def start(bot: Bot):
+    """Starts posting digests to LOG_CHANNEL_ID, if one is configured (idempotent)."""
+    global _bot, _task
+    if _task or not config.LOG_CHANNEL_ID:
+        return
+    _bot = bot
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    """Sends a last digest and stops the digest loop."""
+    global _task
+    if _task:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+        await _send_digest()
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+from typing import Any
+
+import torch
+from PIL import Image
+from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Globals for the loaded pre-classifier ---
+classifier: AutoModelForImageClassification | None = None
+image_processor: AutoImageProcessor | None = None
+_unsafe_label_ids: list[int] = []
+
+# --- Escalation counters ---
+_stats = {"decided_safe": 0, "decided_flagged": 0, "escalated": 0}
+_lock = threading.Lock()
+
+
+def load_classifier():
+    """
+    Loads the CPU pre-classifier from the local cache.
+    The cascade is optional: on failure it is disabled and every item goes to the VLM.
+    """
+    global classifier, image_processor, _unsafe_label_ids
+
+    model_id = config.CASCADE_MODEL_ID
+    local_path = os.path.join(config.LOCAL_MODELS_BASE_DIR, model_id.replace("/", "_"))
+    try:
+        logger.info(f"Loading cascade pre-classifier from: {local_path}")
+        if not os.path.exists(local_path) or not os.listdir(local_path):
+            raise OSError(f"Model directory not found or empty at {local_path}")
+
+        image_processor = AutoImageProcessor.from_pretrained(local_path)
+        classifier = AutoModelForImageClassification.from_pretrained(
+            local_path, torch_dtype=torch.float32
+        ).eval()
+
+        labels = {label.lower(): index for index, label in classifier.config.id2label.items()}
+        _unsafe_label_ids = [labels[label] for label in config.CASCADE_UNSAFE_LABELS if label in labels]
+        if not _unsafe_label_ids:
+            raise ValueError(f"None of {config.CASCADE_UNSAFE_LABELS} in labels {list(labels)}")
+
+        logger.info("Cascade pre-classifier loaded successfully on device: cpu")
+    except Exception:
+        classifier = None
+        logger.warning(
+            "Cascade pre-classifier failed to load, all media will go to the main VLM. "
+            "Run the download script to fetch it: python3 scripts/download.py",
+            exc_info=True,
+        )
+
+
+def is_enabled() -> bool:
+    """Returns True if the cascade stage is configured and loaded."""
+    return config.CASCADE_ENABLED and classifier is not None
+
+
+def score(images: list[Image.Image]) -> list[float]:
+    """Returns the probability that each image is unsafe, in one batched pass."""
+    inputs = image_processor(images, return_tensors="pt")
+    with torch.no_grad():
+        logits = classifier(**inputs).logits
+    probs = torch.softmax(logits.float(), dim=-1)
+    return probs[:, _unsafe_label_ids].sum(dim=-1).tolist()
+
+
+def decide(probability: float) -> bool | None:
+    """
+    Decides an item from its pre-classifier score.
+    Returns False (safe), True (flagged) or None to escalate it to the VLM.
+    """
+    if probability <= config.CASCADE_LOWER_BAND:
+        decision, counter = False, "decided_safe"
+    elif probability >= config.CASCADE_UPPER_BAND:
+        decision, counter = True, "decided_flagged"
+    else:
+        decision, counter = None, "escalated"
+    with _lock:
+        _stats[counter] += 1
+    return decision
+
+
+def get_stats() -> dict[str, Any]:
+    """Returns the decision counters and the fraction of items escalated to the VLM."""
+    with _lock:
+        stats: dict[str, Any] = dict(_stats)
+    total = stats["decided_safe"] + stats["decided_flagged"] + stats["escalated"]
+    stats["total"] = total
+    stats["escalation_rate"] = stats["escalated"] / total if total else 0.0
+    return stats
@@ -1,19 +1,115 @@
 import sqlite3
 import logging
-from config import DATABASE_PATH
+import queue
+import threading
+import time
+from config import DATABASE_PATH, DB_WRITE_BATCH_SIZE, DB_WRITE_BATCH_MS
 
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    """Establishes and returns a database connection."""
-    conn = sqlite3.connect(DATABASE_PATH)
+# --- Long-lived connections ---
+# Reads share one connection guarded by a lock. Writes are queued and committed
+# in batches by a dedicated writer thread with its own connection; WAL mode lets
+# the two work concurrently.
+_reader: sqlite3.Connection | None = None
+_read_lock = threading.Lock()
+_write_queue: queue.Queue = queue.Queue()
+_writer: threading.Thread | None = None
+
+# --- In-memory exception sets: chat_id -> {file_unique_id} ---
+_exceptions: dict[int, set[str]] = {}
+
+
+def get_db_connection() -> sqlite3.Connection:
+    """Opens a database connection in WAL mode."""
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row  # This allows accessing columns by name
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
     return conn
 
+def _get_reader() -> sqlite3.Connection:
+    """Returns the shared read connection, opening it on first use."""
+    global _reader
+    if _reader is None:
+        _reader = get_db_connection()
+    return _reader
+
+def _execute_batch(conn: sqlite3.Connection, batch: list[tuple[str, tuple | dict]]):
+    """Commits a batch of writes in one transaction, isolating failing statements."""
+    try:
+        with conn:
+            for sql, params in batch:
+                conn.execute(sql, params)
+        return
+    except sqlite3.Error as e:
+        logger.warning(f"Batched write failed, retrying statements one by one: {e}")
+
+    for sql, params in batch:
+        try:
+            with conn:
+                conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"Database write failed ({sql.split()[0]}): {e}")
+
+def _writer_loop():
+    """Drains the write queue into batched transactions."""
+    conn = get_db_connection()
+    while True:
+        batch = [_write_queue.get()]
+        deadline = time.monotonic() + DB_WRITE_BATCH_MS / 1000
+        while len(batch) < DB_WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        writes = [item for item in batch if item is not None]
+        if writes:
+            _execute_batch(conn, writes)
+        for _ in batch:
+            _write_queue.task_done()
+        if len(writes) < len(batch):
+            conn.close()
+            return
+
+def _start_writer():
+    """Starts the background writer thread (idempotent)."""
+    global _writer
+    if _writer and _writer.is_alive():
+        return
+    _writer = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+    _writer.start()
+
+def _enqueue_write(sql: str, params: tuple | dict):
+    """Queues a write for the writer thread; it is committed within DB_WRITE_BATCH_MS."""
+    _write_queue.put((sql, params))
+
+def flush():
+    """Blocks until every queued write has been committed."""
+    if _writer and _writer.is_alive():
+        _write_queue.join()
+
+def close_db():
+    """Commits pending writes, stops the writer thread and closes the connections."""
+    global _reader
+    if _writer and _writer.is_alive():
+        _write_queue.put(None)
+        _writer.join()
+    with _read_lock:
+        if _reader is not None:
+            _reader.close()
+            _reader = None
+    logger.info("Database closed.")
+
 def init_db():
     """Initializes the database and creates tables if they don't exist."""
     try:
-        with get_db_connection() as conn:
+        with _read_lock:
+            conn = _get_reader()
             cursor = conn.cursor()
             
             # Create the chats table
@@ -35,9 +131,70 @@ def init_db():
                     UNIQUE(chat_id, file_unique_id)
                 )
             """)
+
+            # Create the perceptual hash table (near-duplicate index for verdicts and exceptions)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS media_hashes (
+                    file_unique_id TEXT PRIMARY KEY,
+                    phash INTEGER NOT NULL
+                )
+            """)
+
+            # Create the persistence table (PTB user/chat/bot/callback/conversation data)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS persistence (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (kind, key)
+                )
+            """)
+
+            # Create the verdict cache table (persistent tier of the verdict cache)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS verdict_cache (
+                    file_unique_id TEXT NOT NULL,
+                    policy_version TEXT NOT NULL,
+                    verdict TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    PRIMARY KEY (file_unique_id, policy_version)
+                )
+            """)
+
+
+            # Create the verdict log (append-only audit trail of moderation decisions)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS verdict_log (
+                    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    message_id INTEGER,
+                    file_unique_id TEXT NOT NULL,
+                    media_type TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    policy_version TEXT NOT NULL,
+                    verdict TEXT NOT NULL,
+                    violations TEXT NOT NULL,
+                    timings TEXT NOT NULL,
+                    action TEXT NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS verdict_log_file
+                ON verdict_log (file_unique_id, chat_id)
+            """)
             
             conn.commit()
-            logger.info("Database initialized successfully.")
+
+            # Exception lookups are served from memory from now on
+            _exceptions.clear()
+            for row in conn.execute("SELECT chat_id, file_unique_id FROM media_exceptions;"):
+                _exceptions.setdefault(row['chat_id'], set()).add(row['file_unique_id'])
+
+        _start_writer()
+        logger.info("Database initialized successfully.")
     except sqlite3.Error as e:
         logger.critical(f"Database initialization failed: {e}")
         raise
@@ -50,55 +207,183 @@ def add_chat(chat_id: int, chat_type: str):
         ON CONFLICT(chat_id) DO UPDATE SET
         is_active = 1, chat_type = excluded.chat_type;
     """
-    try:
-        with get_db_connection() as conn:
-            conn.execute(sql, (chat_id, chat_type))
-            conn.commit()
-            logger.info(f"Added/Reactivated chat: {chat_id}")
-    except sqlite3.Error as e:
-        logger.error(f"Failed to add chat {chat_id}: {e}")
+    _enqueue_write(sql, (chat_id, chat_type))
+    logger.info(f"Added/Reactivated chat: {chat_id}")
 
 def set_chat_inactive(chat_id: int):
     """Marks a chat as inactive in the database."""
     sql = "UPDATE chats SET is_active = 0 WHERE chat_id = ?;"
-    try:
-        with get_db_connection() as conn:
-            conn.execute(sql, (chat_id,))
-            conn.commit()
-            logger.info(f"Deactivated chat: {chat_id}")
-    except sqlite3.Error as e:
-        logger.error(f"Failed to deactivate chat {chat_id}: {e}")
+    _enqueue_write(sql, (chat_id,))
+    logger.info(f"Deactivated chat: {chat_id}")
 
 def get_all_active_chats() -> list[int]:
     """Retrieves a list of all active chat IDs for broadcasting."""
     try:
-        with get_db_connection() as conn:
+        with _read_lock:
+            conn = _get_reader()
             cursor = conn.execute("SELECT chat_id FROM chats WHERE is_active = 1;")
             return [row['chat_id'] for row in cursor.fetchall()]
     except sqlite3.Error as e:
         logger.error(f"Failed to get active chats: {e}")
         return []
 
-def add_media_exception(chat_id: int, file_unique_id: str) -> bool:
-    """Adds a media exception for a specific chat."""
-    sql = "INSERT OR IGNORE INTO media_exceptions (chat_id, file_unique_id) VALUES (?, ?);"
+def get_chat_settings(chat_id: int) -> str | None:
+    """Returns the settings JSON of a chat, or None if the chat is unknown."""
+    sql = "SELECT settings FROM chats WHERE chat_id = ?;"
     try:
-        with get_db_connection() as conn:
-            conn.execute(sql, (chat_id, file_unique_id))
-            conn.commit()
-            logger.info(f"Added exception for file {file_unique_id} in chat {chat_id}")
-            return True
+        with _read_lock:
+            conn = _get_reader()
+            row = conn.execute(sql, (chat_id,)).fetchone()
+            return row['settings'] if row else None
     except sqlite3.Error as e:
-        logger.error(f"Failed to add exception for file {file_unique_id} in {chat_id}: {e}")
+        logger.error(f"Failed to read settings of chat {chat_id}: {e}")
+        return None
+
+def save_chat_settings(chat_id: int, chat_type: str, settings: str):
+    """Stores the settings JSON of a chat, adding the chat if needed."""
+    sql = """
+        INSERT INTO chats (chat_id, chat_type, settings)
+        VALUES (?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET settings = excluded.settings;
+    """
+    _enqueue_write(sql, (chat_id, chat_type, settings))
+
+def add_media_exception(chat_id: int, file_unique_id: str) -> bool:
+    """
+    Adds a media exception for a specific chat (in memory at once, on disk shortly after).
+    Returns False if the writer thread is not running, so it could not be saved.
+    """
+    if not (_writer and _writer.is_alive()):
+        logger.error(f"Database writer not running, cannot save exception for {file_unique_id} in chat {chat_id}")
         return False
+    sql = "INSERT OR IGNORE INTO media_exceptions (chat_id, file_unique_id) VALUES (?, ?);"
+    _exceptions.setdefault(chat_id, set()).add(file_unique_id)
+    _enqueue_write(sql, (chat_id, file_unique_id))
+    logger.info(f"Added exception for file {file_unique_id} in chat {chat_id}")
+    return True
 
 def check_media_exception(chat_id: int, file_unique_id: str) -> bool:
-    """Checks if a media item is in the exception list for a chat."""
-    sql = "SELECT 1 FROM media_exceptions WHERE chat_id = ? AND file_unique_id = ?;"
+    """Checks if a media item is in the exception list for a chat (never touches disk)."""
+    chat_exceptions = _exceptions.get(chat_id)
+    return chat_exceptions is not None and file_unique_id in chat_exceptions
+
+def get_cached_verdict(file_unique_id: str, policy_version: str) -> str | None:
+    """Returns the stored verdict JSON for a file, or None if it was never analyzed."""
+    sql = "SELECT verdict FROM verdict_cache WHERE file_unique_id = ? AND policy_version = ?;"
     try:
-        with get_db_connection() as conn:
-            cursor = conn.execute(sql, (chat_id, file_unique_id))
-            return cursor.fetchone() is not None
+        with _read_lock:
+            conn = _get_reader()
+            row = conn.execute(sql, (file_unique_id, policy_version)).fetchone()
+            return row['verdict'] if row else None
     except sqlite3.Error as e:
-        logger.error(f"Failed to check exception for file {file_unique_id} in {chat_id}: {e}")
-        return False
\ No newline at end of file
+        logger.error(f"Failed to read cached verdict for file {file_unique_id}: {e}")
+        return None
+
+def save_cached_verdict(file_unique_id: str, policy_version: str, verdict: str):
+    """Stores (or replaces) the verdict JSON for a file."""
+    sql = """
+        INSERT OR REPLACE INTO verdict_cache (file_unique_id, policy_version, verdict, created_at)
+        VALUES (?, ?, ?, strftime('%s', 'now'));
+    """
+    _enqueue_write(sql, (file_unique_id, policy_version, verdict))
+
+def add_verdict_record(record: dict):
+    """Appends a moderation decision to the verdict log (JSON fields already encoded)."""
+    sql = """
+        INSERT INTO verdict_log (
+            created_at, chat_id, user_id, message_id, file_unique_id, media_type, source,
+            model, policy_version, verdict, violations, timings, action
+        )
+        VALUES (
+            :created_at, :chat_id, :user_id, :message_id, :file_unique_id, :media_type, :source,
+            :model, :policy_version, :verdict, :violations, :timings, :action
+        );
+    """
+    _enqueue_write(sql, record)
+
+def get_verdict_record(file_unique_id: str, chat_id: int | None = None) -> dict | None:
+    """Returns the latest verdict log entry for a file (in a chat, if given), or None."""
+    sql = "SELECT * FROM verdict_log WHERE file_unique_id = ?"
+    params: tuple = (file_unique_id,)
+    if chat_id is not None:
+        sql += " AND chat_id = ?"
+        params += (chat_id,)
+    sql += " ORDER BY log_id DESC LIMIT 1;"
+    try:
+        with _read_lock:
+            conn = _get_reader()
+            row = conn.execute(sql, params).fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Failed to read the verdict log for file {file_unique_id}: {e}")
+        return None
+
+def add_media_hash(file_unique_id: str, phash: int):
+    """Stores the perceptual hash of a media item (as a signed 64-bit integer)."""
+    sql = "INSERT OR REPLACE INTO media_hashes (file_unique_id, phash) VALUES (?, ?);"
+    _enqueue_write(sql, (file_unique_id, phash))
+
+def get_media_hash(file_unique_id: str) -> int | None:
+    """Returns the stored perceptual hash of a media item, if any."""
+    sql = "SELECT phash FROM media_hashes WHERE file_unique_id = ?;"
+    try:
+        with _read_lock:
+            conn = _get_reader()
+            row = conn.execute(sql, (file_unique_id,)).fetchone()
+            return row['phash'] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Failed to read hash for file {file_unique_id}: {e}")
+        return None
+
+def get_verdict_hashes(policy_version: str) -> list[tuple[str, int]]:
+    """Returns (file_unique_id, phash) for every hashed media item with a cached verdict."""
+    sql = """
+        SELECT h.file_unique_id, h.phash FROM media_hashes h
+        JOIN verdict_cache v ON v.file_unique_id = h.file_unique_id
+        WHERE v.policy_version = ?;
+    """
+    try:
+        with _read_lock:
+            conn = _get_reader()
+            cursor = conn.execute(sql, (policy_version,))
+            return [(row['file_unique_id'], row['phash']) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load verdict hashes: {e}")
+        return []
+
+def get_exception_hashes() -> list[tuple[int, int]]:
+    """Returns (chat_id, phash) for every media exception with a known hash."""
+    sql = """
+        SELECT e.chat_id, h.phash FROM media_exceptions e
+        JOIN media_hashes h ON h.file_unique_id = e.file_unique_id;
+    """
+    try:
+        with _read_lock:
+            conn = _get_reader()
+            cursor = conn.execute(sql)
+            return [(row['chat_id'], row['phash']) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load exception hashes: {e}")
+        return []
+
+def get_persistence_rows(kind: str) -> list[tuple[str, bytes]]:
+    """Returns (key, data) for every persisted row of one kind."""
+    sql = "SELECT key, data FROM persistence WHERE kind = ?;"
+    try:
+        with _read_lock:
+            conn = _get_reader()
+            cursor = conn.execute(sql, (kind,))
+            return [(row['key'], row['data']) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load persisted {kind} data: {e}")
+        return []
+
+def save_persistence_row(kind: str, key: str, data: bytes):
+    """Stores (or replaces) one persisted row."""
+    sql = "INSERT OR REPLACE INTO persistence (kind, key, data) VALUES (?, ?, ?);"
+    _enqueue_write(sql, (kind, key, data))
+
+def delete_persistence_row(kind: str, key: str):
+    """Deletes one persisted row."""
+    sql = "DELETE FROM persistence WHERE kind = ? AND key = ?;"
+    _enqueue_write(sql, (kind, key))
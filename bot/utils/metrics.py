@@ -0,0 +1,124 @@
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Any, Iterator
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets from 1 ms (cache lookups) up to a minute (cold video inference)
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "nsfwbot_stage_seconds",
+    "Time spent in each stage of the moderation pipeline.",
+    ["stage"],
+    buckets=_BUCKETS,
+)
+MEDIA_TOTAL = Counter(
+    "nsfwbot_media_total",
+    "Media items handled, by outcome (flagged, safe, error, cache_hit, near_duplicate, excepted).",
+    ["outcome"],
+)
+MEDIA_IN_FLIGHT = Gauge(
+    "nsfwbot_media_in_flight",
+    "Media items currently being handled.",
+)
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "nsfwbot_inference_queue_depth",
+    "Requests waiting for the inference worker.",
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    "nsfwbot_inference_batch_size",
+    "Images per inference micro-batch.",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32),
+)
+MODERATION_QUEUE_DEPTH = Gauge(
+    "nsfwbot_moderation_queue_depth",
+    "Media waiting in the moderation scheduler, by priority (and deferred).",
+    ["priority"],
+)
+MODERATION_JOBS = Counter(
+    "nsfwbot_moderation_jobs_total",
+    "Moderation scheduler events (admitted, shed, deferred, degraded), by priority.",
+    ["event", "priority"],
+)
+MODEL_READY = Gauge(
+    "nsfwbot_model_ready",
+    "1 once the model is loaded, 0 while loading or after a failed load.",
+)
+
+# Stage timings of the media item handled by the current task, for the trace line
+_trace: contextvars.ContextVar[dict[str, Any] | None] = contextvars.ContextVar(
+    "metrics_trace", default=None
+)
+
+
+@contextlib.contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Observes the duration of the wrapped block in the stage histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def observe(stage: str, seconds: float):
+    """Records a stage duration measured by the caller."""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    trace = _trace.get()
+    if trace is not None:
+        stages = trace["stages"]
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def stage_timings() -> dict[str, float]:
+    """Returns the stage durations (seconds) recorded so far for the current media item."""
+    trace = _trace.get()
+    return dict(trace["stages"]) if trace is not None else {}
+
+
+def count(outcome: str):
+    """Increments the media outcome counter."""
+    MEDIA_TOTAL.labels(outcome).inc()
+
+
+@contextlib.contextmanager
+def trace(**fields: Any) -> Iterator[None]:
+    """
+    Tracks one media item: counts it as in flight and, with METRICS_TRACE_LOG,
+    logs the time of every stage it went through in a single DEBUG line.
+    Tasks started inside the block (e.g. gathered frame analyses) add their
+    stages to the same line (summed, so they can exceed the total).
+    """
+    record = {"fields": fields, "stages": {}}
+    token = _trace.set(record)
+    started = time.perf_counter()
+    MEDIA_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        MEDIA_IN_FLIGHT.dec()
+        _trace.reset(token)
+        if config.METRICS_TRACE_LOG and logger.isEnabledFor(logging.DEBUG):
+            total = (time.perf_counter() - started) * 1000
+            parts = [f"{key}={value}" for key, value in fields.items()]
+            parts += [f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in record["stages"].items()]
+            logger.debug(f"trace {' '.join(parts)} total={total:.1f}ms")
+
+
+def start_server():
+    """Serves the metrics in Prometheus text format on METRICS_HOST:METRICS_PORT."""
+    if not config.METRICS_ENABLED:
+        return
+    try:
+        start_http_server(config.METRICS_PORT, addr=config.METRICS_HOST)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on port {config.METRICS_PORT}: {e}")
+        return
+    logger.info(f"Metrics endpoint listening on http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics")
@@ -0,0 +1,333 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+from typing import Any
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+import config
+from bot.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram deletes at most this many messages per delete_messages call
+_MAX_BULK_DELETE = 100
+
+
+class TokenBucket:
+    """Allows `rate` actions per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Returns how long until one token is available (0 if it is now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def drain(self):
+        """Empties the bucket, e.g. after Telegram asked us to slow down."""
+        self.tokens = min(self.tokens, 0.0)
+
+
+_bot: Bot | None = None
+_task: asyncio.Task | None = None
+_wakeup: asyncio.Event | None = None
+
+# chat_id -> message ids waiting to be deleted, sent as one bulk call
+_deletions: dict[int, list[int]] = {}
+# (due time, chat_id, message_id) of delayed deletions, e.g. warning notices
+_scheduled: list[tuple[float, int, int]] = []
+# chat_id -> the chat's current warning notice, see notify_deletion
+_notices: dict[int, dict[str, Any]] = {}
+# Chats with work to do, in round-robin order (dict as an ordered set)
+_pending: dict[int, None] = {}
+# Chats with a call in flight; each chat has at most one, to keep its order
+_busy: set[int] = set()
+_blocked_until: dict[int, float] = {}
+
+_global_bucket = TokenBucket(config.OUTBOX_GLOBAL_RATE, config.OUTBOX_GLOBAL_RATE)
+_chat_buckets: dict[int, TokenBucket] = {}
+
+_stats = {"deleted": 0, "delete_calls": 0, "notices_sent": 0, "notices_edited": 0, "retry_after": 0, "failed": 0}
+
+
+def _mark(chat_id: int):
+    _pending.setdefault(chat_id, None)
+    if _wakeup:
+        _wakeup.set()
+
+
+def _has_work(chat_id: int) -> bool:
+    notice = _notices.get(chat_id)
+    return bool(_deletions.get(chat_id)) or bool(notice and notice["dirty"])
+
+
+def delete(chat_id: int, message_id: int, delay: float = 0):
+    """Queues a message for deletion, after `delay` seconds."""
+    if delay > 0:
+        heapq.heappush(_scheduled, (time.monotonic() + delay, chat_id, message_id))
+        if _wakeup:
+            _wakeup.set()
+        return
+    _deletions.setdefault(chat_id, []).append(message_id)
+    _mark(chat_id)
+
+
+def notify_deletion(chat_id: int, user_html: str, reasons: str, buttons: list[tuple[str, str]]):
+    """
+    Reports a deleted message in the chat. While the chat's last notice is younger
+    than OUTBOX_NOTICE_MERGE_SECONDS, it is edited to list this deletion too,
+    instead of sending another message. `buttons` are (label, callback_data) pairs.
+    """
+    now = time.monotonic()
+    notice = _notices.get(chat_id)
+    if notice is None or now - notice["created"] > config.OUTBOX_NOTICE_MERGE_SECONDS:
+        notice = {"message_id": None, "entries": [], "created": now, "delete_at": None, "dirty": True}
+        _notices[chat_id] = notice
+    notice["entries"].append((user_html, reasons, buttons))
+    notice["dirty"] = True
+    if notice["message_id"] is not None and config.WARNING_MSG_DELETE_SECONDS > 0:
+        # Keep a merged notice up for the full time after its latest deletion
+        notice["delete_at"] = now + config.WARNING_MSG_DELETE_SECONDS
+    _mark(chat_id)
+
+
+def forget_notice(chat_id: int, message_id: int):
+    """Stops merging into a notice (e.g. once an admin acted on it and it was edited)."""
+    notice = _notices.get(chat_id)
+    if notice and notice["message_id"] == message_id:
+        del _notices[chat_id]
+
+
+def _render(notice: dict[str, Any]) -> tuple[str, InlineKeyboardMarkup]:
+    """Renders a notice: one line per deletion, buttons for the latest ones."""
+    entries = notice["entries"]
+    if len(entries) == 1:
+        user_html, reasons, buttons = entries[0]
+        text = f"Message from {user_html} deleted (Reason: {reasons})."
+        keyboard = [[InlineKeyboardButton(label, callback_data=data) for label, data in buttons]]
+        return text, InlineKeyboardMarkup(keyboard)
+
+    shown = entries[-config.OUTBOX_NOTICE_MAX_LINES:]
+    first = len(entries) - len(shown) + 1
+    lines = [f"{len(entries)} messages deleted:"]
+    if first > 1:
+        lines.append(f"… {first - 1} earlier")
+    lines += [
+        f"#{number} {user_html} ({reasons})"
+        for number, (user_html, reasons, _) in enumerate(shown, start=first)
+    ]
+    keyboard = [
+        [InlineKeyboardButton(f"{label} #{number}", callback_data=data) for label, data in buttons]
+        for number, (_, _, buttons) in enumerate(entries, start=1)
+    ][-config.OUTBOX_NOTICE_MAX_BUTTON_ROWS:]
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    if isinstance(error.retry_after, datetime.timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+
+async def _send_deletions(chat_id: int):
+    message_ids = _deletions.pop(chat_id, [])
+    batch, rest = message_ids[:_MAX_BULK_DELETE], message_ids[_MAX_BULK_DELETE:]
+    if rest:
+        _deletions[chat_id] = rest
+    try:
+        with metrics.timed("delete"):
+            await _bot.delete_messages(chat_id, batch)
+        _stats["delete_calls"] += 1
+        _stats["deleted"] += len(batch)
+        logger.info(f"Deleted {len(batch)} messages in chat {chat_id}")
+    except RetryAfter:
+        _deletions[chat_id] = batch + _deletions.get(chat_id, [])
+        raise
+    except TelegramError as e:
+        _stats["failed"] += 1
+        logger.error(f"Failed to delete {len(batch)} messages in {chat_id}: {e}")
+
+
+async def _send_notice(chat_id: int):
+    notice = _notices[chat_id]
+    notice["dirty"] = False
+    text, reply_markup = _render(notice)
+    try:
+        with metrics.timed("send_message"):
+            if notice["message_id"] is None:
+                message = await _bot.send_message(
+                    chat_id, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
+                )
+                notice["message_id"] = message.message_id
+                _stats["notices_sent"] += 1
+                if config.WARNING_MSG_DELETE_SECONDS > 0:
+                    notice["delete_at"] = time.monotonic() + config.WARNING_MSG_DELETE_SECONDS
+                    delete(chat_id, message.message_id, config.WARNING_MSG_DELETE_SECONDS)
+            else:
+                await _bot.edit_message_text(
+                    text, chat_id, notice["message_id"],
+                    reply_markup=reply_markup, parse_mode=ParseMode.HTML,
+                )
+                _stats["notices_edited"] += 1
+    except RetryAfter:
+        notice["dirty"] = True
+        raise
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            _stats["failed"] += 1
+            logger.error(f"Failed to update the notice in {chat_id}: {e}")
+    except TelegramError as e:
+        _stats["failed"] += 1
+        logger.error(f"Failed to send the notice in {chat_id}: {e}")
+        if notice["message_id"] is None and _notices.get(chat_id) is notice:
+            del _notices[chat_id]
+
+
+async def _perform(chat_id: int):
+    """Makes one call for a chat: pending deletions first, then its notice."""
+    try:
+        if _deletions.get(chat_id):
+            await _send_deletions(chat_id)
+        elif chat_id in _notices:
+            await _send_notice(chat_id)
+    except RetryAfter as e:
+        seconds = _retry_seconds(e)
+        _stats["retry_after"] += 1
+        _blocked_until[chat_id] = time.monotonic() + seconds
+        _global_bucket.drain()
+        logger.warning(f"Flood limit in chat {chat_id}, retrying in {seconds:.0f}s")
+    except Exception as e:
+        _stats["failed"] += 1
+        logger.error(f"Outbound action in {chat_id} failed: {e}", exc_info=True)
+    finally:
+        _busy.discard(chat_id)
+        _pending.pop(chat_id, None)
+        if _has_work(chat_id):
+            # Back of the line, behind the other chats
+            _mark(chat_id)
+        elif _wakeup:
+            _wakeup.set()
+
+
+def _promote_due(now: float):
+    """Moves delayed deletions that are due into the bulk deletion queues."""
+    while _scheduled and _scheduled[0][0] <= now:
+        _, chat_id, message_id = heapq.heappop(_scheduled)
+        notice = _notices.get(chat_id)
+        if notice and notice["message_id"] == message_id:
+            if notice["delete_at"] and notice["delete_at"] > now:
+                # The notice was extended by a merge, check again later
+                heapq.heappush(_scheduled, (notice["delete_at"], chat_id, message_id))
+                continue
+            del _notices[chat_id]
+        delete(chat_id, message_id)
+
+
+def _dispatch(now: float) -> float:
+    """Starts a call for every chat the rate limits allow. Returns the time until the next check."""
+    delay = _scheduled[0][0] - now if _scheduled else 1.0
+    for chat_id in list(_pending):
+        if chat_id in _busy:
+            continue
+        if len(_busy) >= config.OUTBOX_CONCURRENCY:
+            break
+        blocked = _blocked_until.get(chat_id, 0) - now
+        if blocked > 0:
+            delay = min(delay, blocked)
+            continue
+        _blocked_until.pop(chat_id, None)
+
+        bucket = _chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _chat_buckets[chat_id] = TokenBucket(
+                config.OUTBOX_CHAT_RATE_PER_MINUTE / 60, config.OUTBOX_CHAT_BURST
+            )
+        wait = max(bucket.wait_time(now), _global_bucket.wait_time(now))
+        if wait > 0:
+            delay = min(delay, wait)
+            continue
+
+        bucket.take(now)
+        _global_bucket.take(now)
+        _busy.add(chat_id)
+        asyncio.create_task(_perform(chat_id))
+    return max(delay, 0.01)
+
+
+async def _run():
+    while True:
+        now = time.monotonic()
+        _promote_due(now)
+        delay = _dispatch(now)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        if len(_chat_buckets) > 1000:
+            _prune_buckets(time.monotonic())
+
+
+def _prune_buckets(now: float):
+    """Forgets the buckets of idle chats that have refilled completely."""
+    for chat_id, bucket in list(_chat_buckets.items()):
+        if chat_id not in _pending and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.burst:
+            del _chat_buckets[chat_id]
+
+
+def start(bot: Bot):
+    """Starts the outbox loop on the running event loop (idempotent)."""
+    global _bot, _task, _wakeup
+    if _task:
+        return
+    _bot = bot
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    """
+    Sends pending deletions and notice updates (for up to OUTBOX_STOP_SECONDS),
+    then stops the outbox loop. Delayed deletions that are not yet due are dropped.
+    """
+    global _task
+    if _task:
+        try:
+            await asyncio.wait_for(drain(), config.OUTBOX_STOP_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox stopped with {len(_pending)} chat(s) still pending")
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+async def drain():
+    """Waits until no immediate deletion or notice update is pending."""
+    while _pending or _busy:
+        await asyncio.sleep(0.01)
+
+
+def get_stats() -> dict[str, Any]:
+    """Returns call counters and queue sizes."""
+    stats: dict[str, Any] = dict(_stats)
+    stats["pending_deletions"] = sum(len(ids) for ids in _deletions.values())
+    stats["scheduled_deletions"] = len(_scheduled)
+    stats["blocked_chats"] = sum(until > time.monotonic() for until in _blocked_until.values())
+    return stats
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+from typing import Any
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from bot.utils import database as db
+
+logger = logging.getLogger(__name__)
+
+# Row kinds in the persistence table
+_USER = "user"
+_CHAT = "chat"
+_BOT = "bot"
+_CALLBACK = "callback"
+_CONVERSATION = "conversation"
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Stores PTB's user_data, chat_data, bot_data, callback data and conversations
+    as individual rows in bot_data.db, instead of one pickle file.
+
+    Each user, chat and conversation entry is its own row, pickled on its own.
+    A row is only rewritten when its pickled content actually changed, and
+    writes go through the database writer thread, which commits them in
+    batched transactions. Flush cost therefore grows with the number of
+    changed entries, not with the total number of chats.
+    """
+
+    def __init__(
+        self, store_data: PersistenceInput | None = None, update_interval: float = 60
+    ):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        # Digest of the last stored blob per (kind, key), to skip unchanged rows
+        self._digests: dict[tuple[str, str], bytes] = {}
+
+    # --- Helpers ---
+
+    def _load(self, kind: str) -> dict[str, Any]:
+        """Loads and unpickles every row of one kind."""
+        data = {}
+        for key, blob in db.get_persistence_rows(kind):
+            try:
+                data[key] = pickle.loads(blob)
+            except Exception as e:
+                logger.error(f"Skipping unreadable persisted {kind} row {key}: {e}")
+                continue
+            self._digests[(kind, key)] = hashlib.blake2b(blob, digest_size=16).digest()
+        return data
+
+    def _store(self, kind: str, key: str, value: Any):
+        """Queues a row write if its content changed since the last write."""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.blake2b(blob, digest_size=16).digest()
+        if self._digests.get((kind, key)) == digest:
+            return
+        self._digests[(kind, key)] = digest
+        db.save_persistence_row(kind, key, blob)
+
+    def _drop(self, kind: str, key: str):
+        """Queues a row deletion."""
+        self._digests.pop((kind, key), None)
+        db.delete_persistence_row(kind, key)
+
+    @staticmethod
+    def _conversation_key(name: str, key: tuple[int | str, ...]) -> str:
+        return json.dumps([name, list(key)])
+
+    # --- Loading ---
+
+    async def get_user_data(self) -> dict[int, Any]:
+        return {int(key): value for key, value in self._load(_USER).items()}
+
+    async def get_chat_data(self) -> dict[int, Any]:
+        return {int(key): value for key, value in self._load(_CHAT).items()}
+
+    async def get_bot_data(self) -> Any:
+        return self._load(_BOT).get("", {})
+
+    async def get_callback_data(self) -> Any:
+        return self._load(_CALLBACK).get("")
+
+    async def get_conversations(self, name: str) -> dict[tuple[int | str, ...], object]:
+        conversations = {}
+        for key, state in self._load(_CONVERSATION).items():
+            conversation_name, conversation_key = json.loads(key)
+            if conversation_name == name:
+                conversations[tuple(conversation_key)] = state
+        return conversations
+
+    # --- Updating ---
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        self._store(_USER, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        self._store(_CHAT, str(chat_id), data)
+
+    async def update_bot_data(self, data: Any) -> None:
+        self._store(_BOT, "", data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._store(_CALLBACK, "", data)
+
+    async def update_conversation(
+        self, name: str, key: tuple[int | str, ...], new_state: object | None
+    ) -> None:
+        row_key = self._conversation_key(name, key)
+        if new_state is None:
+            self._drop(_CONVERSATION, row_key)
+        else:
+            self._store(_CONVERSATION, row_key, new_state)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop(_USER, str(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop(_CHAT, str(chat_id))
+
+    # --- Refreshing: the in-memory data is authoritative, nothing to reload ---
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Waits until all queued rows are committed."""
+        await asyncio.to_thread(db.flush)
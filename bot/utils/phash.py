@@ -0,0 +1,197 @@
+import io
+import logging
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+import config
+from bot.utils import database as db
+from bot.utils import verdict_cache
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+_SAMPLE_SIZE = HASH_SIZE * 4
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Builds an orthonormal DCT-II matrix, so a 2D DCT is two matrix products."""
+    k = np.arange(n, dtype=np.float64)[:, None]
+    i = np.arange(n, dtype=np.float64)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(_SAMPLE_SIZE)
+
+
+def compute_hash(image_content: bytes | Image.Image) -> int | None:
+    """
+    Computes the 64-bit DCT perceptual hash (pHash) of an image.
+    Returns None if the image cannot be decoded.
+    """
+    try:
+        if isinstance(image_content, Image.Image):
+            image = image_content
+        else:
+            image = Image.open(io.BytesIO(image_content))
+            # JPEG only: let the decoder downscale, we only need a 32x32 thumbnail
+            image.draft("L", (_SAMPLE_SIZE * 2, _SAMPLE_SIZE * 2))
+        gray = image.convert("L").resize(
+            (_SAMPLE_SIZE, _SAMPLE_SIZE), Image.Resampling.LANCZOS
+        )
+    except Exception as e:
+        logger.warning(f"Failed to decode image for hashing: {e}")
+        return None
+
+    pixels = np.asarray(gray, dtype=np.float32)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term only carries mean brightness, keep it out of the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming(a: int, b: int) -> int:
+    """Returns the Hamming distance between two hashes."""
+    return (a ^ b).bit_count()
+
+
+def to_signed(value: int) -> int:
+    """Converts an unsigned 64-bit hash into the signed form SQLite can store."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value: int) -> int:
+    """Converts a hash read back from SQLite into its unsigned form."""
+    return value & ((1 << 64) - 1)
+
+
+class BKTree:
+    """A BK-tree over 64-bit hashes, searchable by Hamming distance."""
+
+    def __init__(self):
+        # Each node is (hash, item, {distance: child_node})
+        self._root: tuple[int, Any, dict] | None = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, hash_value: int, item: Any):
+        """Inserts an item under the given hash."""
+        self._size += 1
+        if self._root is None:
+            self._root = (hash_value, item, {})
+            return
+
+        node = self._root
+        while True:
+            distance = hamming(hash_value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (hash_value, item, {})
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> list[tuple[int, Any]]:
+        """Returns (distance, item) pairs within max_distance, closest first."""
+        if self._root is None:
+            return []
+
+        results = []
+        stack = [self._root]
+        while stack:
+            node_hash, item, children = stack.pop()
+            distance = hamming(hash_value, node_hash)
+            if distance <= max_distance:
+                results.append((distance, item))
+            # Triangle inequality: only subtrees in this band can contain matches
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+# --- In-memory indexes, loaded from the database at startup ---
+_verdict_index = BKTree()
+_exception_index: dict[int, BKTree] = {}
+_stats = {"near_duplicate_hits": 0, "exception_hits": 0}
+
+
+def load_index():
+    """Builds the in-memory indexes from the media_hashes table."""
+    global _verdict_index, _exception_index
+
+    verdict_index = BKTree()
+    for file_unique_id, phash in db.get_verdict_hashes(verdict_cache.policy_version()):
+        verdict_index.add(to_unsigned(phash), file_unique_id)
+
+    exception_index: dict[int, BKTree] = {}
+    for chat_id, phash in db.get_exception_hashes():
+        exception_index.setdefault(chat_id, BKTree()).add(to_unsigned(phash), chat_id)
+
+    _verdict_index, _exception_index = verdict_index, exception_index
+    logger.info(
+        f"Loaded hash index: {len(verdict_index)} verdicts, "
+        f"{sum(len(tree) for tree in exception_index.values())} exceptions"
+    )
+
+
+def add_verdict_hash(file_unique_id: str, phash: int):
+    """Records the hash of an analyzed media item so re-uploads can reuse its verdict."""
+    db.add_media_hash(file_unique_id, to_signed(phash))
+    _verdict_index.add(phash, file_unique_id)
+
+
+def find_verdict(phash: int) -> dict[str, Any] | None:
+    """Returns the verdict of the closest already-judged near-duplicate, if any."""
+    for distance, file_unique_id in _verdict_index.search(phash, config.PHASH_MAX_DISTANCE):
+        verdict = verdict_cache.get_verdict(file_unique_id, record_stats=False)
+        if verdict is not None:
+            _stats["near_duplicate_hits"] += 1
+            logger.debug(f"Near-duplicate of {file_unique_id} (distance {distance})")
+            return verdict
+    return None
+
+
+def add_exception(chat_id: int, file_unique_id: str) -> bool:
+    """
+    Extends a chat's exception to visually identical re-uploads.
+    Returns False if the media item was never hashed.
+    """
+    phash = db.get_media_hash(file_unique_id)
+    if phash is None:
+        return False
+    _exception_index.setdefault(chat_id, BKTree()).add(to_unsigned(phash), chat_id)
+    return True
+
+
+def is_excepted(chat_id: int, phash: int) -> bool:
+    """Checks if a media item is a near-duplicate of an exception in this chat."""
+    tree = _exception_index.get(chat_id)
+    if tree is None or not tree.search(phash, config.PHASH_MAX_DISTANCE):
+        return False
+    _stats["exception_hits"] += 1
+    return True
+
+
+def is_excepted_file(chat_id: int, file_unique_id: str) -> bool:
+    """
+    Checks a media item hashed on an earlier upload (e.g. a verdict cache hit)
+    against the chat's exceptions, using its stored hash.
+    """
+    if chat_id not in _exception_index:
+        return False
+    phash = db.get_media_hash(file_unique_id)
+    return phash is not None and is_excepted(chat_id, to_unsigned(phash))
+
+
+def get_stats() -> dict[str, Any]:
+    """Returns near-duplicate counters and index sizes."""
+    stats: dict[str, Any] = dict(_stats)
+    stats["indexed_verdicts"] = len(_verdict_index)
+    stats["indexed_exceptions"] = sum(len(tree) for tree in _exception_index.values())
+    return stats
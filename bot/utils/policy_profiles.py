@@ -0,0 +1,93 @@
+import json
+import logging
+from typing import Any
+
+import config
+from bot.utils import database as db
+
+logger = logging.getLogger(__name__)
+
+# Short names used in notices, reports and the /policy command
+POLICY_LABELS = {
+    "is_nsfw": "NSFW",
+    "is_violence": "Gore/Violence",
+    "is_drugs": "Drugs",
+}
+
+# chat_id -> profile; every chat is read from the chats table at most once
+_profiles: dict[int, dict[str, Any]] = {}
+
+
+def label(key: str) -> str:
+    """Returns the display name of a policy."""
+    return POLICY_LABELS.get(key, key.removeprefix("is_").replace("_", " ").title())
+
+
+def default_profile() -> dict[str, Any]:
+    """Every configured policy at its configured threshold, with video frame sampling."""
+    return {
+        "policies": {key: config.POLICY_THRESHOLDS.get(key, 0.5) for key in config.DETECTION_POLICIES},
+        "sample_video": True,
+    }
+
+
+def _from_settings(settings: dict[str, Any]) -> dict[str, Any]:
+    """Builds a profile from stored chat settings, ignoring policies no longer configured."""
+    profile = default_profile()
+    policies = settings.get("policies")
+    if isinstance(policies, dict):
+        profile["policies"] = {
+            key: float(threshold) for key, threshold in policies.items() if key in config.DETECTION_POLICIES
+        }
+    if "sample_video" in settings:
+        profile["sample_video"] = bool(settings["sample_video"])
+    return profile
+
+
+def get_profile(chat_id: int) -> dict[str, Any]:
+    """
+    Returns the policy profile of a chat: {"policies": {key: threshold}, "sample_video": bool}.
+    Served from memory; the chat's settings are loaded on first use.
+    """
+    profile = _profiles.get(chat_id)
+    if profile is None:
+        settings = db.get_chat_settings(chat_id)
+        try:
+            profile = _from_settings(json.loads(settings)) if settings else default_profile()
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring invalid settings of chat {chat_id}: {e}")
+            profile = default_profile()
+        _profiles[chat_id] = profile
+    return profile
+
+
+def save_profile(chat_id: int, chat_type: str, profile: dict[str, Any]):
+    """Replaces a chat's profile in memory at once and on disk shortly after."""
+    settings_json = db.get_chat_settings(chat_id)
+    try:
+        settings = json.loads(settings_json) if settings_json else {}
+    except ValueError:
+        settings = {}
+    settings.update(policies=profile["policies"], sample_video=profile["sample_video"])
+    _profiles[chat_id] = profile
+    db.save_chat_settings(chat_id, chat_type, json.dumps(settings))
+    logger.info(f"Updated policy profile of chat {chat_id}: {settings}")
+
+
+def evaluate(analysis: dict[str, Any], profile: dict[str, Any]) -> list[str] | None:
+    """
+    Returns the enabled policies a verdict violates under the chat's thresholds,
+    re-derived from its scores. Returns None if the verdict does not cover the
+    profile (it lacks the score of an enabled policy and violates none), so the
+    media has to be analyzed again for this chat. A verdict settled by the NSFW
+    pre-classifier alone only has the is_nsfw score.
+    """
+    if analysis.get("thumbnail") and profile["sample_video"]:
+        # Judged by its thumbnail for a chat that does not sample video frames
+        return None
+    policies = profile["policies"]
+    scores = analysis.get("scores", {})
+    violated = [key for key, threshold in policies.items() if scores.get(key, -1.0) >= threshold]
+    if violated or all(key in scores for key in policies):
+        return violated
+    return None
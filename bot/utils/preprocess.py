@@ -0,0 +1,169 @@
+import asyncio
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import numpy as np
+from PIL import Image
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Transparent pixels (stickers) are composited onto this background
+ALPHA_BACKGROUND = (255, 255, 255)
+
+# Model input normalization: pixels = uint8 * _scale + _offset, per channel.
+# The defaults are SigLIP's (rescale 1/255, mean 0.5, std 0.5): x / 127.5 - 1.
+_size = config.MODEL_INPUT_SIZE
+_resample = Image.Resampling.BICUBIC
+_scale = np.full((3, 1, 1), 1 / 127.5, dtype=np.float32)
+_offset = np.full((3, 1, 1), -1.0, dtype=np.float32)
+
+_executor: ThreadPoolExecutor | None = None
+
+
+class BufferPool:
+    """Reuses preallocated pixel buffers; allocates more when all are in use."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._free: list[np.ndarray] = []
+        self._lock = threading.Lock()
+
+    def _shape(self) -> tuple[int, int, int]:
+        return (3, _size, _size)
+
+    def acquire(self) -> np.ndarray:
+        with self._lock:
+            while self._free:
+                buffer = self._free.pop()
+                if buffer.shape == self._shape():
+                    return buffer
+        return np.empty(self._shape(), dtype=np.float32)
+
+    def release(self, buffer: np.ndarray):
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(buffer)
+
+    def fill(self):
+        """Preallocates the whole pool."""
+        with self._lock:
+            while len(self._free) < self.size:
+                self._free.append(np.empty(self._shape(), dtype=np.float32))
+
+
+_pool = BufferPool(config.PREPROCESS_BUFFERS)
+
+
+class PreparedImage:
+    """
+    A decoded image at the model input size (`image`, e.g. for the cascade) and
+    its normalized channels-first pixels (`pixels`), ready to be batched.
+    """
+
+    __slots__ = ("image", "pixels")
+
+    def __init__(self, image: Image.Image, pixels: np.ndarray):
+        self.image = image
+        self.pixels = pixels
+
+    def release(self):
+        """Returns the pixel buffer to the pool once it was copied into a batch."""
+        if self.pixels is not None:
+            _pool.release(self.pixels)
+            self.pixels = None
+
+
+def configure(image_processor: Any):
+    """Takes the input size, resampling and normalization from the model's image processor."""
+    global _size, _resample, _scale, _offset
+    size = getattr(image_processor, "size", None) or {}
+    _size = size.get("height", config.MODEL_INPUT_SIZE)
+    resample = getattr(image_processor, "resample", None)
+    if resample is not None:
+        _resample = Image.Resampling(int(resample))
+    rescale = getattr(image_processor, "rescale_factor", 1 / 255) if getattr(image_processor, "do_rescale", True) else 1.0
+    mean = np.asarray(getattr(image_processor, "image_mean", None) or [0.5] * 3, dtype=np.float32)
+    std = np.asarray(getattr(image_processor, "image_std", None) or [0.5] * 3, dtype=np.float32)
+    if not getattr(image_processor, "do_normalize", True):
+        mean, std = np.zeros(3, dtype=np.float32), np.ones(3, dtype=np.float32)
+    _scale = (rescale / std).reshape(3, 1, 1).astype(np.float32)
+    _offset = (-mean / std).reshape(3, 1, 1).astype(np.float32)
+    _pool.fill()
+    logger.info(f"Preprocessing: {_size}x{_size}, {_resample.name}, mean {mean.tolist()}, std {std.tolist()}")
+
+
+def decode(image_content: bytes | Image.Image) -> Image.Image:
+    """
+    Decodes an image into RGB. Animated images (WebP stickers, GIFs) give their
+    first frame; transparency is composited onto ALPHA_BACKGROUND.
+    """
+    if isinstance(image_content, Image.Image):
+        image = image_content
+    else:
+        image = Image.open(io.BytesIO(image_content))
+        if getattr(image, "is_animated", False):
+            image.seek(0)
+        # JPEG only: decode at a reduced scale that still covers the model input
+        image.draft("RGB", (_size, _size))
+
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA", "PA"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, ALPHA_BACKGROUND + (255,))
+        return Image.alpha_composite(background, image).convert("RGB")
+    return image.convert("RGB")
+
+
+def resize(image: Image.Image) -> Image.Image:
+    """Resizes an RGB image to the model input size (as the model's processor would)."""
+    if image.size == (_size, _size):
+        return image
+    return image.resize((_size, _size), _resample)
+
+
+def prepare(image_content: bytes | Image.Image) -> PreparedImage:
+    """Decodes, resizes and normalizes one image into a pooled pixel buffer."""
+    image = resize(decode(image_content))
+    pixels = _pool.acquire()
+    # HWC uint8 -> CHW float32, normalized in place
+    np.multiply(np.asarray(image).transpose(2, 0, 1), _scale, out=pixels)
+    np.add(pixels, _offset, out=pixels)
+    return PreparedImage(image, pixels)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(config.PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+    return _executor
+
+
+async def run_in_pool(function: Callable[..., Any], *args: Any) -> Any:
+    """Runs another decoding step (e.g. perceptual hashing) on the preprocessing threads."""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), function, *args)
+
+
+async def prepare_many(image_contents: list[bytes | Image.Image]) -> list[PreparedImage | None]:
+    """
+    Prepares several images concurrently on the preprocessing threads (PIL and
+    NumPy release the GIL). Images that cannot be decoded give None.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    prepared = await asyncio.gather(
+        *(loop.run_in_executor(executor, prepare, image_content) for image_content in image_contents),
+        return_exceptions=True,
+    )
+    results = []
+    for item in prepared:
+        if isinstance(item, Exception):
+            logger.error(f"Failed to decode image: {item}")
+            item = None
+        results.append(item)
+    return results
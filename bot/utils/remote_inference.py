@@ -0,0 +1,317 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import struct
+from typing import Any
+
+from PIL import Image
+
+import config
+from bot.utils import ai_models
+
+logger = logging.getLogger(__name__)
+
+# Wire format, in both directions: two big-endian uint32 lengths, a JSON header
+# and a raw body (image bytes on requests, empty on responses).
+_FRAME = struct.Struct(">II")
+_MAX_HEADER_BYTES = 1024 * 1024
+_MAX_BODY_BYTES = config.DOWNLOAD_MAX_BYTES + 16 * 1024 * 1024
+
+
+class WorkerUnavailable(Exception):
+    """Raised when a worker connection is down or drops while a request is pending."""
+
+
+# --- Wire helpers ---
+
+async def _read_frame(reader: asyncio.StreamReader) -> tuple[dict[str, Any], bytes]:
+    header_size, body_size = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    if header_size > _MAX_HEADER_BYTES or body_size > _MAX_BODY_BYTES:
+        raise ConnectionError(f"Oversized frame ({header_size} + {body_size} bytes)")
+    header = json.loads(await reader.readexactly(header_size))
+    body = await reader.readexactly(body_size) if body_size else b""
+    return header, body
+
+
+def _write_frame(writer: asyncio.StreamWriter, header: dict[str, Any], body: bytes = b""):
+    data = json.dumps(header).encode()
+    writer.write(_FRAME.pack(len(data), len(body)) + data)
+    if body:
+        writer.write(body)
+
+
+def _encode_image(image_content: bytes | Image.Image) -> tuple[dict[str, Any], bytes]:
+    """Sends encoded files as they are and decoded video frames as raw RGB."""
+    if isinstance(image_content, Image.Image):
+        image = image_content.convert("RGB")
+        return {"format": "rgb", "size": list(image.size)}, image.tobytes()
+    return {"format": "encoded"}, image_content
+
+
+def _decode_image(header: dict[str, Any], body: bytes) -> bytes | Image.Image:
+    if header.get("format") == "rgb":
+        return Image.frombytes("RGB", tuple(header["size"]), body)
+    return body
+
+
+async def _open_connection(address: str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Connects to "unix:/path/to.sock" or "host:port" (optionally prefixed with "tcp:")."""
+    if address.startswith("unix:"):
+        return await asyncio.open_unix_connection(address[len("unix:"):], limit=_MAX_BODY_BYTES)
+    host, _, port = address.removeprefix("tcp:").rpartition(":")
+    return await asyncio.open_connection(host, int(port), limit=_MAX_BODY_BYTES)
+
+
+# --- Worker side ---
+
+async def _serve_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answers the requests of one front-end connection, each in its own task."""
+    write_lock = asyncio.Lock()
+    tasks: set[asyncio.Task] = set()
+
+    async def handle(header: dict[str, Any], body: bytes):
+        if header.get("op") == "ping":
+            state = ai_models.readiness()["state"]
+            result = {"ready": state == "ready", "state": state, "queue_depth": ai_models.queue_depth()}
+        else:
+            result = await ai_models.analyze_async(
+                _decode_image(header, body),
+                early_exit=header.get("early_exit", False),
+                cascade_only=header.get("cascade_only", False),
+                policies=header.get("policies"),
+            )
+        async with write_lock:
+            _write_frame(writer, {"id": header["id"], "result": result})
+            await writer.drain()
+
+    try:
+        while True:
+            header, body = await _read_frame(reader)
+            task = asyncio.create_task(handle(header, body))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        logger.info(f"Front end disconnected: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+
+
+async def serve(address: str):
+    """
+    Loads the model in the background and serves inference requests on `address`.
+    Exits if the model fails to load, so the front end sees the worker go away.
+    """
+    loop = asyncio.get_running_loop()
+    failed = asyncio.Event()
+    ai_models.start_loading(on_failure=lambda: loop.call_soon_threadsafe(failed.set))
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(_serve_connection, path, limit=_MAX_BODY_BYTES)
+    else:
+        host, _, port = address.removeprefix("tcp:").rpartition(":")
+        server = await asyncio.start_server(_serve_connection, host, int(port), limit=_MAX_BODY_BYTES)
+    logger.info(f"Inference worker listening on {address}")
+    async with server:
+        # start_server already serves; this only waits for a failed load
+        await failed.wait()
+    raise SystemExit("Essential models failed to load. Exiting.")
+
+
+# --- Front-end side ---
+
+class _Worker:
+    """One connection to an inference worker, multiplexing requests by id."""
+
+    def __init__(self, address: str):
+        self.address = address
+        self.healthy = False
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._write_lock = asyncio.Lock()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._read_task: asyncio.Task | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def connect(self):
+        self._reader, self._writer = await _open_connection(self.address)
+        self._read_task = asyncio.create_task(self._read_loop(self._reader))
+        logger.info(f"Connected to inference worker {self.address}")
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                header, _ = await _read_frame(reader)
+                future = self._pending.pop(header["id"], None)
+                if future and not future.done():
+                    future.set_result(header["result"])
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            # A stale loop of an earlier connection must not close the current one
+            if reader is self._reader:
+                self.disconnect(f"connection lost ({e})")
+
+    def disconnect(self, reason: str):
+        """Closes the connection and fails its pending requests so they are re-dispatched."""
+        if self._writer is None:
+            return
+        logger.warning(f"Inference worker {self.address} is down: {reason}")
+        self.healthy = False
+        self._writer.close()
+        self._reader = self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(WorkerUnavailable(self.address))
+
+    async def request(self, header: dict[str, Any], body: bytes, timeout: float) -> dict[str, Any]:
+        """Sends one request and waits for its response."""
+        if self._writer is None:
+            raise WorkerUnavailable(self.address)
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            async with self._write_lock:
+                if self._writer is None:
+                    raise WorkerUnavailable(self.address)
+                try:
+                    _write_frame(self._writer, dict(header, id=request_id), body)
+                    await self._writer.drain()
+                except (ConnectionError, OSError) as e:
+                    self.disconnect(f"send failed ({e})")
+                    raise WorkerUnavailable(self.address) from e
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+
+_workers: list[_Worker] = []
+_available: asyncio.Event | None = None
+_health_task: asyncio.Task | None = None
+_stats = {"requests": 0, "redispatched": 0, "unavailable": 0}
+
+
+def is_enabled() -> bool:
+    """Checks if inference runs in worker processes (INFERENCE_WORKERS is set)."""
+    return bool(config.INFERENCE_WORKERS)
+
+
+async def _check_worker(worker: _Worker):
+    """Reconnects a worker if needed and pings it; only ready workers receive requests."""
+    try:
+        if not worker.connected:
+            await worker.connect()
+        result = await worker.request({"op": "ping"}, b"", config.INFERENCE_HEALTH_TIMEOUT_SECONDS)
+        worker.healthy = result.get("ready", False)
+    except asyncio.TimeoutError:
+        worker.disconnect("health check timed out")
+    except (WorkerUnavailable, ConnectionError, OSError) as e:
+        worker.healthy = False
+        logger.debug(f"Inference worker {worker.address} unreachable: {e}")
+
+
+async def _health_loop():
+    while True:
+        await asyncio.gather(*(_check_worker(worker) for worker in _workers))
+        if any(worker.healthy for worker in _workers):
+            _available.set()
+        else:
+            _available.clear()
+        await asyncio.sleep(config.INFERENCE_HEALTH_INTERVAL_SECONDS)
+
+
+def start():
+    """Starts health checking the configured workers (on the running event loop)."""
+    global _available, _health_task
+    if _health_task:
+        return
+    _workers[:] = [_Worker(address) for address in config.INFERENCE_WORKERS]
+    _available = asyncio.Event()
+    _health_task = asyncio.create_task(_health_loop())
+    logger.info(f"Using {len(_workers)} remote inference workers.")
+
+
+async def stop():
+    """Stops health checks and closes all worker connections."""
+    global _health_task
+    if _health_task:
+        _health_task.cancel()
+        _health_task = None
+    for worker in _workers:
+        worker.disconnect("shutting down")
+
+
+def _rank(key: str) -> list[_Worker]:
+    """
+    Orders the healthy workers by rendezvous hash of (key, address). The same
+    file_unique_id always goes to the same worker, and losing a worker only
+    moves the keys it owned.
+    """
+    def weight(worker: _Worker) -> bytes:
+        return hashlib.blake2b(f"{key}|{worker.address}".encode(), digest_size=8).digest()
+    return sorted((worker for worker in _workers if worker.healthy), key=weight, reverse=True)
+
+
+async def analyze(
+    image_content: bytes | Image.Image,
+    key: str,
+    early_exit: bool = False,
+    cascade_only: bool = False,
+    timeout: float | None = None,
+    policies: dict[str, float] | None = None,
+) -> dict[str, Any]:
+    """
+    Analyzes an image on the worker owning `key`, with the same result format
+    as ai_models.analyze_async. If that worker dies, the request moves on to
+    the next one. Waits up to MODEL_READY_TIMEOUT_SECONDS for a ready worker.
+    """
+    if timeout is None:
+        timeout = config.INFERENCE_TIMEOUT_SECONDS
+    _stats["requests"] += 1
+
+    if not _available.is_set():
+        try:
+            await asyncio.wait_for(_available.wait(), config.MODEL_READY_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            _stats["unavailable"] += 1
+            return {"error": "No inference worker available"}
+
+    header, body = _encode_image(image_content)
+    header.update(op="analyze", key=key, early_exit=early_exit, cascade_only=cascade_only, policies=policies)
+    for attempt, worker in enumerate(_rank(key)):
+        if attempt:
+            _stats["redispatched"] += 1
+        try:
+            return await worker.request(header, body, timeout)
+        except WorkerUnavailable:
+            logger.warning(f"Re-dispatching {key}: worker {worker.address} is unavailable")
+        except asyncio.TimeoutError:
+            logger.warning(f"Inference request for {key} timed out after {timeout}s on {worker.address}")
+            return {"error": "Inference timed out"}
+
+    _stats["unavailable"] += 1
+    return {"error": "No inference worker available"}
+
+
+def get_stats() -> dict[str, Any]:
+    """Returns request counters and the state of each worker."""
+    stats: dict[str, Any] = dict(_stats)
+    stats["workers"] = [
+        {"address": worker.address, "healthy": worker.healthy, "in_flight": worker.in_flight}
+        for worker in _workers
+    ]
+    return stats
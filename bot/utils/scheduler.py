@@ -0,0 +1,267 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable
+
+from telegram import Bot, Chat
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.error import TelegramError
+
+import config
+from bot.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priorities, served strictly in this order
+PRIORITY_ADMIN_GROUP = 0
+PRIORITY_GROUP = 1
+PRIORITY_PRIVATE = 2
+PRIORITY_NAMES = ("admin_group", "group", "private")
+
+# A job is (run, trace fields, enqueue time, priority, chat_id); run receives the active degradations
+Job = tuple[Callable[[frozenset[str]], Awaitable[None]], dict[str, Any], float, int, int]
+
+# Per priority: chat_id -> that chat's queued jobs, in round-robin order
+_queues: list[OrderedDict[int, deque[Job]]] = [OrderedDict() for _ in PRIORITY_NAMES]
+_size = 0
+_running = 0
+# chat_id -> completion of that chat's latest started job; each job acts after
+# the one started before it is done, see wait_turn
+_last_jobs: dict[int, asyncio.Future] = {}
+# The previous job of the chat, for the job run by the current task
+_previous_job: contextvars.ContextVar[asyncio.Future | None] = contextvars.ContextVar(
+    "scheduler_previous_job", default=None
+)
+# Private-chat jobs parked outside the bounded queue while overloaded
+_deferred: deque[tuple[int, Job]] = deque()
+_wakeup: asyncio.Event | None = None
+_workers: list[asyncio.Task] = []
+
+# chat_id -> whether the bot is an administrator there
+_admin_chats: dict[int, bool] = {}
+
+_stats = {"admitted": 0, "shed": 0, "deferred": 0, "degraded": 0}
+
+
+def set_admin(chat_id: int, is_admin: bool):
+    """Records the bot's admin status in a chat (from my_chat_member updates)."""
+    _admin_chats[chat_id] = is_admin
+
+
+async def chat_priority(bot: Bot, chat: Chat) -> int:
+    """Returns the scheduling priority of a chat, looking up admin status once per chat."""
+    if chat.type == ChatType.PRIVATE:
+        return PRIORITY_PRIVATE
+    if chat.id not in _admin_chats:
+        try:
+            member = await bot.get_chat_member(chat.id, bot.id)
+            _admin_chats[chat.id] = member.status == ChatMemberStatus.ADMINISTRATOR
+        except TelegramError as e:
+            logger.warning(f"Failed to check bot admin status in {chat.id}: {e}")
+            _admin_chats[chat.id] = False
+    return PRIORITY_ADMIN_GROUP if _admin_chats[chat.id] else PRIORITY_GROUP
+
+
+def is_overloaded() -> bool:
+    """Checks if the queue has reached MODERATION_OVERLOAD_THRESHOLD."""
+    return _size >= config.MODERATION_OVERLOAD_THRESHOLD
+
+
+def active_degradations() -> frozenset[str]:
+    """Returns the configured degradations if the scheduler is overloaded."""
+    if not is_overloaded():
+        return frozenset()
+    return frozenset(config.MODERATION_DEGRADATION) - {"defer_private"}
+
+
+def _count(event: str, priority: int):
+    _stats[event] += 1
+    metrics.MODERATION_JOBS.labels(event, PRIORITY_NAMES[priority]).inc()
+
+
+def _push(chat_id: int, priority: int, job: Job):
+    global _size
+    _queues[priority].setdefault(chat_id, deque()).append(job)
+    _size += 1
+    if _wakeup:
+        _wakeup.set()
+
+
+def _shed_lowest(below: int) -> bool:
+    """Drops the newest job of the longest chat queue with a priority worse than `below`."""
+    global _size
+    for priority in range(len(_queues) - 1, below, -1):
+        chats = _queues[priority]
+        if not chats:
+            continue
+        chat_id = max(chats, key=lambda chat: len(chats[chat]))
+        chats[chat_id].pop()
+        if not chats[chat_id]:
+            del chats[chat_id]
+        _size -= 1
+        _count("shed", priority)
+        logger.warning(f"Shed queued {PRIORITY_NAMES[priority]} media from chat {chat_id}")
+        return True
+    return False
+
+
+def submit(
+    chat_id: int,
+    priority: int,
+    run: Callable[[frozenset[str]], Awaitable[None]],
+    **fields: Any,
+) -> bool:
+    """
+    Admits a moderation job. `fields` label its trace log line.
+    Returns False if the job was shed because the queues are full.
+    """
+    job: Job = (run, fields, time.monotonic(), priority, chat_id)
+
+    if priority == PRIORITY_PRIVATE and is_overloaded() and "defer_private" in config.MODERATION_DEGRADATION:
+        if len(_deferred) < config.MODERATION_DEFERRED_SIZE:
+            _deferred.append((chat_id, job))
+            _count("deferred", priority)
+            return True
+        _count("shed", priority)
+        return False
+
+    chat_queue = _queues[priority].get(chat_id)
+    if chat_queue is not None and len(chat_queue) >= config.MODERATION_CHAT_QUEUE_SIZE:
+        _count("shed", priority)
+        return False
+    if _size >= config.MODERATION_QUEUE_SIZE and not _shed_lowest(priority):
+        _count("shed", priority)
+        return False
+
+    _push(chat_id, priority, job)
+    _count("admitted", priority)
+    return True
+
+
+def _next_job() -> Job | None:
+    """Pops the next job: highest priority first, round-robin across chats."""
+    global _size
+    while _deferred and not is_overloaded():
+        chat_id, job = _deferred.popleft()
+        _push(chat_id, PRIORITY_PRIVATE, job)
+
+    for chats in _queues:
+        if not chats:
+            continue
+        chat_id = next(iter(chats))
+        chat_queue = chats.pop(chat_id)
+        job = chat_queue.popleft()
+        if chat_queue:
+            # Back of the line, behind every other chat of this priority
+            chats[chat_id] = chat_queue
+        _size -= 1
+        return job
+    return None
+
+
+async def wait_turn():
+    """
+    Waits until the chat's previous job is done. Jobs of one chat download and
+    analyze concurrently; a job calls this before acting (deleting, notifying,
+    reporting), so its actions follow the order in which the media arrived.
+    """
+    previous = _previous_job.get()
+    if previous is not None:
+        await asyncio.shield(previous)
+
+
+async def _worker_loop():
+    """Runs queued moderation jobs, one at a time per worker."""
+    global _running
+    while True:
+        job = _next_job()
+        if job is None:
+            _wakeup.clear()
+            await _wakeup.wait()
+            continue
+
+        run, fields, enqueued_at, priority, chat_id = job
+        degradations = active_degradations()
+        if degradations:
+            _count("degraded", priority)
+        _running += 1
+        done = asyncio.get_running_loop().create_future()
+        _previous_job.set(_last_jobs.get(chat_id))
+        _last_jobs[chat_id] = done
+        try:
+            with metrics.trace(**fields):
+                metrics.observe("queue_wait", time.monotonic() - enqueued_at)
+                with metrics.timed("processing"):
+                    await run(degradations)
+        except Exception as e:
+            logger.error(f"Moderation job failed ({fields}): {e}", exc_info=True)
+        finally:
+            _running -= 1
+            done.set_result(None)
+            if _last_jobs.get(chat_id) is done:
+                del _last_jobs[chat_id]
+
+
+def start():
+    """Starts the worker tasks on the running event loop (idempotent)."""
+    global _wakeup
+    if _workers:
+        return
+    _wakeup = asyncio.Event()
+    for _ in range(config.MODERATION_WORKERS):
+        _workers.append(asyncio.create_task(_worker_loop()))
+    logger.info(f"Moderation scheduler started with {config.MODERATION_WORKERS} workers.")
+
+
+async def stop():
+    """
+    Drops queued jobs, lets running ones finish (for up to MODERATION_STOP_SECONDS)
+    and cancels the worker tasks.
+    """
+    global _size
+    for chats in _queues:
+        chats.clear()
+    _deferred.clear()
+    _size = 0
+    try:
+        await asyncio.wait_for(drain(), config.MODERATION_STOP_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"Cancelling {_running} running moderation job(s)")
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+async def drain():
+    """Waits until no job is queued, deferred or running."""
+    while _size or _deferred or _running:
+        await asyncio.sleep(0.01)
+
+
+def queue_sizes() -> dict[str, int]:
+    """Returns the number of queued jobs per priority, plus deferred ones."""
+    sizes = {
+        name: sum(len(chat_queue) for chat_queue in chats.values())
+        for name, chats in zip(PRIORITY_NAMES, _queues)
+    }
+    sizes["deferred"] = len(_deferred)
+    return sizes
+
+
+def get_stats() -> dict[str, Any]:
+    """Returns admission counters and current queue sizes."""
+    stats: dict[str, Any] = dict(_stats)
+    stats.update(queue_sizes())
+    stats["running"] = _running
+    stats["overloaded"] = is_overloaded()
+    return stats
+
+
+for _priority, _name in enumerate(PRIORITY_NAMES):
+    metrics.MODERATION_QUEUE_DEPTH.labels(_name).set_function(
+        lambda chats=_queues[_priority]: sum(len(chat_queue) for chat_queue in chats.values())
+    )
+metrics.MODERATION_QUEUE_DEPTH.labels("deferred").set_function(lambda: len(_deferred))
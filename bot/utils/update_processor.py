@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Limit of the base class, which holds its semaphore while an update waits for
+# its chat. It only bounds the updates in flight; UPDATE_CONCURRENCY is applied
+# once an update has its chat's turn.
+MAX_PENDING_UPDATES = 10_000
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to max_concurrent_updates updates at once, but never two
+    updates of the same chat: those run one after another, in arrival order.
+    Updates without a chat (e.g. inline queries) are not ordered. Updates
+    waiting for their chat do not take one of the max_concurrent_updates slots.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(MAX_PENDING_UPDATES)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> (lock, number of updates holding or waiting for it)
+        self._chat_locks: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running:
+                await coroutine
+            return
+
+        lock, users = self._chat_locks.get(chat.id, (asyncio.Lock(), 0))
+        self._chat_locks[chat.id] = (lock, users + 1)
+        try:
+            # asyncio.Lock wakes waiters first-in, first-out
+            async with lock, self._running:
+                await coroutine
+        finally:
+            lock, users = self._chat_locks[chat.id]
+            if users == 1:
+                del self._chat_locks[chat.id]
+            else:
+                self._chat_locks[chat.id] = (lock, users - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,98 @@
+import functools
+import hashlib
+import json
+import logging
+import threading
+from typing import Any
+
+from cachetools import TTLCache
+
+import config
+from bot.utils import database as db
+
+logger = logging.getLogger(__name__)
+
+# --- Memory tier: bounded LRU cache with a TTL ---
+_memory: TTLCache = TTLCache(maxsize=config.CACHE_MAX_SIZE, ttl=config.CACHE_TTL_SECONDS)
+_lock = threading.Lock()
+
+# --- Hit/miss counters ---
+_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0}
+
+
+@functools.cache
+def policy_version() -> str:
+    """
+    Returns a short fingerprint of the model and policy configuration.
+    Changing the model, a prompt, the keywords or the scoring invalidates old verdicts.
+    """
+    fingerprint = json.dumps(
+        {
+            "model": config.HF_MODEL_ID,
+            "backend": config.INFERENCE_BACKEND,
+            "policies": config.DETECTION_POLICIES,
+            "keywords": config.VIOLATION_KEYWORDS,
+            "mode": config.ANALYSIS_MODE,
+            "thresholds": config.POLICY_THRESHOLDS,
+            "cascade": [
+                config.CASCADE_ENABLED,
+                config.CASCADE_MODEL_ID,
+                config.CASCADE_LOWER_BAND,
+                config.CASCADE_UPPER_BAND,
+            ],
+            "video": [
+                config.VIDEO_SAMPLING,
+                config.VIDEO_MAX_FRAMES,
+                config.VIDEO_FRAME_AGGREGATION,
+            ],
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+
+
+def get_verdict(file_unique_id: str, record_stats: bool = True) -> dict[str, Any] | None:
+    """
+    Looks up a verdict in the memory tier, then the SQLite tier.
+    Internal lookups (e.g. from the near-duplicate index) pass record_stats=False.
+    """
+    key = (file_unique_id, policy_version())
+    with _lock:
+        verdict = _memory.get(key)
+        if verdict is not None:
+            if record_stats:
+                _stats["memory_hits"] += 1
+            return dict(verdict)
+
+    stored = db.get_cached_verdict(*key)
+    with _lock:
+        if stored is None:
+            if record_stats:
+                _stats["misses"] += 1
+            return None
+        verdict = json.loads(stored)
+        _memory[key] = verdict
+        if record_stats:
+            _stats["db_hits"] += 1
+    return dict(verdict)
+
+
+def store_verdict(file_unique_id: str, verdict: dict[str, Any]):
+    """Stores a successful analysis result in both tiers (degraded verdicts are not reused)."""
+    if "error" in verdict or verdict.get("degraded"):
+        return
+    key = (file_unique_id, policy_version())
+    with _lock:
+        _memory[key] = dict(verdict)
+        _stats["stores"] += 1
+    db.save_cached_verdict(*key, json.dumps(verdict))
+
+
+def get_stats() -> dict[str, Any]:
+    """Returns the hit/miss counters and the current memory tier size."""
+    with _lock:
+        stats: dict[str, Any] = dict(_stats)
+        stats["memory_size"] = len(_memory)
+    lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["memory_hits"] + stats["db_hits"]) / lookups if lookups else 0.0
+    return stats
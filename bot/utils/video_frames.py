@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import re
+import tempfile
+from typing import Any
+
+from PIL import Image
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# "Duration: 00:01:02.50" in ffmpeg's description of its input
+_DURATION_PATTERN = re.compile(rb"Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)")
+
+
+def _build_args(input_path: str, duration: float | None, large: bool) -> list[str]:
+    """Builds the ffmpeg arguments that decode sampled frames to raw RGB on stdout."""
+    size = config.VIDEO_FRAME_SIZE
+    span = min(duration or config.VIDEO_DEFAULT_SECONDS, config.VIDEO_MAX_SECONDS)
+
+    if config.VIDEO_SAMPLING == "scene":
+        # First frame plus every scene change, up to VIDEO_MAX_FRAMES
+        sampler = f"select='eq(n\\,0)+gt(scene\\,{config.VIDEO_SCENE_THRESHOLD})'"
+    else:
+        # VIDEO_MAX_FRAMES frames spread uniformly over the decoded span
+        sampler = f"fps={config.VIDEO_MAX_FRAMES}/{max(span, 0.1):.3f}"
+
+    args = ["-hide_banner", "-loglevel", "error"]
+    if large:
+        # Above the pixel budget only keyframes are decoded
+        args += ["-skip_frame", "nokey"]
+    args += [
+        "-t", f"{config.VIDEO_MAX_SECONDS}",
+        "-i", input_path,
+        "-vf", f"{sampler},scale={size}:{size}",
+        "-vsync", "vfr",
+        "-frames:v", f"{config.VIDEO_MAX_FRAMES}",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "pipe:1",
+    ]
+    return args
+
+
+async def _run_ffmpeg(args: list[str], video_content: bytes | None) -> list[Image.Image]:
+    """
+    Runs ffmpeg as an asyncio subprocess, feeding the video on stdin (if given)
+    and reading fixed-size raw frames from stdout as they are produced.
+    """
+    size = config.VIDEO_FRAME_SIZE
+    frame_bytes = size * size * 3
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", *args,
+            stdin=asyncio.subprocess.PIPE if video_content is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        logger.error("FFmpeg error: ffmpeg executable not found")
+        return []
+
+    async def feed():
+        try:
+            process.stdin.write(video_content)
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg stops reading once it has enough frames
+        finally:
+            process.stdin.close()
+
+    feeder = asyncio.create_task(feed()) if video_content is not None else None
+    frames: list[Image.Image] = []
+    try:
+        while len(frames) < config.VIDEO_MAX_FRAMES:
+            data = await process.stdout.readexactly(frame_bytes)
+            frames.append(Image.frombytes("RGB", (size, size), data))
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        # Enough frames (or a timeout): the rest of the clip is not needed
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        if feeder:
+            await feeder
+        stderr = await process.stderr.read()
+        await process.wait()
+
+    if not frames and stderr:
+        logger.error(f"FFmpeg error: {stderr.decode(errors='replace').strip()}")
+    return frames
+
+
+async def extract_frames(
+    video_content: bytes, duration: float | None = None, pixels: int | None = None
+) -> list[Image.Image]:
+    """
+    Samples up to VIDEO_MAX_FRAMES frames from a video held in memory.
+    Frames are streamed from ffmpeg over a pipe, already resized to the model input.
+    Returns an empty list if nothing could be decoded.
+    """
+    large = bool(pixels and pixels > config.VIDEO_MAX_DECODE_PIXELS)
+    try:
+        frames = await asyncio.wait_for(
+            _run_ffmpeg(_build_args("pipe:0", duration, large), video_content),
+            config.VIDEO_DECODE_TIMEOUT_SECONDS,
+        )
+        if frames:
+            return frames
+
+        # MP4 files with the index at the end cannot be demuxed from a pipe
+        logger.debug("No frames decoded from pipe, retrying from a seekable file")
+        with tempfile.NamedTemporaryFile(suffix=".video") as video_file:
+            video_file.write(video_content)
+            video_file.flush()
+            return await extract_frames_from_file(video_file.name, duration, pixels)
+    except asyncio.TimeoutError:
+        logger.error(f"FFmpeg error: decoding timed out after {config.VIDEO_DECODE_TIMEOUT_SECONDS}s")
+        return []
+
+
+async def extract_frames_from_file(
+    path: str, duration: float | None = None, pixels: int | None = None
+) -> list[Image.Image]:
+    """Samples up to VIDEO_MAX_FRAMES frames from a video file, like extract_frames."""
+    large = bool(pixels and pixels > config.VIDEO_MAX_DECODE_PIXELS)
+    try:
+        return await asyncio.wait_for(
+            _run_ffmpeg(_build_args(path, duration, large), None),
+            config.VIDEO_DECODE_TIMEOUT_SECONDS,
+        )
+    except asyncio.TimeoutError:
+        logger.error(f"FFmpeg error: decoding timed out after {config.VIDEO_DECODE_TIMEOUT_SECONDS}s")
+        return []
+
+
+async def probe_duration(path: str) -> float | None:
+    """
+    Reads the duration of a video file from its container metadata (as printed
+    by ffmpeg, which is all the bot requires). Returns None if it is unknown.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-i", path,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        # Without an output ffmpeg only describes the input and exits
+        _, stderr = await asyncio.wait_for(process.communicate(), config.VIDEO_DECODE_TIMEOUT_SECONDS)
+    except FileNotFoundError:
+        logger.error("FFmpeg error: ffmpeg executable not found")
+        return None
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return None
+    match = _DURATION_PATTERN.search(stderr)
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return duration if duration > 0 else None
+
+
+def aggregate_frames(
+    frame_results: list[dict[str, Any]], thresholds: dict[str, float] | None = None
+) -> dict[str, Any]:
+    """
+    Combines per-frame analysis results into one verdict for the whole clip,
+    according to VIDEO_FRAME_AGGREGATION:
+      "any"      - flagged if any frame is flagged, scores are the maximum
+      "majority" - flagged if more than half the frames are flagged, scores are
+                   the highest that a majority of frames reach
+      "mean"     - flagged if the mean score reaches the policy threshold
+    Either way a policy is flagged exactly when its combined score reaches the
+    threshold, so verdicts can be re-judged at other thresholds.
+    `thresholds` defaults to POLICY_THRESHOLDS.
+    """
+    valid = [result for result in frame_results if "error" not in result]
+    if not valid:
+        return frame_results[0] if frame_results else {"error": "No frames analyzed"}
+    if len(valid) == 1:
+        return valid[0]
+    if thresholds is None:
+        thresholds = config.POLICY_THRESHOLDS
+
+    mode = config.VIDEO_FRAME_AGGREGATION
+    combined: dict[str, Any] = {"scores": {}, "frames": len(valid)}
+    for key in config.DETECTION_POLICIES:
+        if not any(key in result or key in result.get("scores", {}) for result in valid):
+            continue
+        scores = [result["scores"][key] for result in valid if key in result.get("scores", {})]
+        if mode == "mean":
+            score = sum(scores) / len(scores) if scores else 0.0
+        elif mode == "majority":
+            # Frames without a score (early exit) count as not flagged
+            ranked = sorted(scores, reverse=True)
+            majority = len(valid) // 2
+            score = ranked[majority] if majority < len(ranked) else 0.0
+        else:
+            score = max(scores, default=0.0)
+        if scores:
+            combined["scores"][key] = score
+        combined[key] = bool(scores) and score >= thresholds.get(key, 0.5)
+
+    combined["general_nsfw_score"] = combined["scores"].get("is_nsfw", 0.0)
+    combined["gore_violence_score"] = combined["scores"].get("is_violence", 0.0)
+    if all(result.get("decided_by") == "cascade" for result in valid):
+        combined["decided_by"] = "cascade"
+    if any(result.get("partial") for result in valid):
+        combined["partial"] = True
+    if any(result.get("degraded") for result in valid):
+        combined["degraded"] = True
+    return combined
@@ -7,7 +7,8 @@ load_dotenv()
 # --- Helper function to safely get integer from .env ---
 def get_int_env(key: str) -> int | None:
     value = os.getenv(key)
-    if value and value.isdigit():
+    # Channel and group ids are negative
+    if value and value.removeprefix("-").isdigit():
         return int(value)
     return None
 
@@ -19,14 +20,36 @@ LOG_CHANNEL_ID = get_int_env("LOG_CHANNEL_ID")
 
 # --- Bot Behavior ---
 WARNING_MSG_DELETE_SECONDS = 60
+# Media is downloaded into memory. Larger files are skipped, or judged by their
+# thumbnail for videos and GIFs.
+DOWNLOAD_MAX_BYTES = 20 * 1024 * 1024
+# Items of an album (media group) arrive as separate updates. They are collected
+# for up to this long, then downloaded, analyzed and acted on together.
+ALBUM_COLLECT_SECONDS = 1.0
 
 
+# --- Outbound Actions ---
+# Deletions and warning notices go through a rate-limited outbox. Deletions of
+# one chat are sent as bulk delete_messages calls; deletions within
+# OUTBOX_NOTICE_MERGE_SECONDS are listed in one notice, edited as they come in.
+OUTBOX_GLOBAL_RATE = 25  # calls per second, across all chats
+OUTBOX_CHAT_RATE_PER_MINUTE = 20
+OUTBOX_CHAT_BURST = 3
+OUTBOX_CONCURRENCY = 8
+OUTBOX_NOTICE_MERGE_SECONDS = 30
+OUTBOX_NOTICE_MAX_LINES = 10
+OUTBOX_NOTICE_MAX_BUTTON_ROWS = 3
+# On shutdown, pending deletions and notice updates get this long to be sent
+OUTBOX_STOP_SECONDS = 10
+
 # --- Database & Persistence ---
+# Bot/chat/user data is persisted row by row in the same database
 DATABASE_NAME = "bot_data.db"
-PERSISTENCE_FILE = "bot_persistence.pickle"
 DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
 DATABASE_PATH = os.path.join(DATA_PATH, DATABASE_NAME)
-PERSISTENCE_PATH = os.path.join(DATA_PATH, PERSISTENCE_FILE)
+# Database writes are queued and committed in batches by a background thread
+DB_WRITE_BATCH_SIZE = 200
+DB_WRITE_BATCH_MS = 100
 
 
 # --- AI Model Configuration ---
@@ -36,6 +59,8 @@ LOCAL_MODELS_BASE_DIR = os.path.join(os.path.dirname(__file__), 'models')
 # Note: The actual model ID from Google may differ upon release.
 # We will use a placeholder that represents this type of model.
 HF_MODEL_ID = "google/paligemma-3b-mix-448" # Using a real, similar VLM as a stand-in
+# Input resolution of the model; larger media is never needed at full size
+MODEL_INPUT_SIZE = 448
 
 # --- NEW: Policy-based detection ---
 # The text prompts we will send to the model along with the image.
@@ -48,6 +73,158 @@ DETECTION_POLICIES = {
 # What we consider a "violation" response from the model
 VIOLATION_KEYWORDS = ["yes", "explicit", "nude", "porn", "gore", "violence", "weapon", "drug", "syringe"]
 
+# How policies are evaluated:
+#   "score"    - one forward pass per policy, P(yes) is read from the answer logits
+#   "generate" - a free-text answer is decoded and matched against VIOLATION_KEYWORDS
+ANALYSIS_MODE = "score"
+# A policy is flagged when its score reaches this threshold (0.0 - 1.0)
+POLICY_THRESHOLDS = {
+    "is_nsfw": 0.5,
+    "is_violence": 0.5,
+    "is_drugs": 0.5,
+}
+
+
+# --- Inference Backend ---
+#   "fp32"         - full precision; usually fastest on CPUs without native bf16
+#   "bf16"         - half the memory; fast on CPUs/GPUs with bf16 support
+#   "int8-dynamic" - fp32 with dynamic int8 quantization of all linear layers (CPU)
+#   "compiled"     - fp32 compiled with torch.compile
+# Use scripts/compare_backends.py to measure speed and accuracy on your hardware.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "bf16")
+# Thread settings (unset = torch defaults)
+TORCH_NUM_THREADS = get_int_env("TORCH_NUM_THREADS")
+TORCH_NUM_INTEROP_THREADS = get_int_env("TORCH_NUM_INTEROP_THREADS")
+# Run one blank image through the model at load time
+INFERENCE_WARMUP = True
+
+
+# --- Cascade Pre-Classifier ---
+# A small CPU image classifier runs before the VLM. Items scoring at or below
+# the lower band are decided safe, at or above the upper band flagged as NSFW;
+# only the uncertain middle band is escalated to the VLM.
+CASCADE_ENABLED = True
+CASCADE_MODEL_ID = "Falconsai/nsfw_image_detection"
+# Classifier labels that count towards the "unsafe" probability
+CASCADE_UNSAFE_LABELS = ["nsfw"]
+CASCADE_LOWER_BAND = 0.05
+CASCADE_UPPER_BAND = 0.97
+
+
+# --- Inference Service ---
+# The model runs on a dedicated worker thread fed through a bounded queue,
+# so Telegram I/O keeps flowing while an image is being analyzed.
+INFERENCE_QUEUE_SIZE = 64
+INFERENCE_TIMEOUT_SECONDS = 60
+# The bot starts polling while the model loads; media waits this long for it
+MODEL_READY_TIMEOUT_SECONDS = 600
+# Requests from all chats are collected into micro-batches. A batch is flushed
+# when it holds INFERENCE_MAX_BATCH_SIZE images, or INFERENCE_MAX_WAIT_MS after
+# its first request arrived, whichever comes first.
+INFERENCE_MAX_BATCH_SIZE = 4
+INFERENCE_MAX_WAIT_MS = 50
+# Images are decoded, resized and normalized on these threads before they reach
+# the inference worker, into a pool of reusable pixel buffers (3 x 448 x 448
+# float32, 2.4 MB each).
+PREPROCESS_WORKERS = get_int_env("PREPROCESS_WORKERS") or min(4, os.cpu_count() or 1)
+PREPROCESS_BUFFERS = 16
+
+
+# --- Inference Workers ---
+# Empty: the model runs inside the bot process. Otherwise a comma-separated list
+# of worker addresses ("unix:/path/to.sock" or "host:port"), each started with
+# `python worker.py --listen <address>` on this or another host. The bot then
+# loads no model; media is sharded across ready workers by file_unique_id.
+INFERENCE_WORKERS = [
+    address.strip() for address in os.getenv("INFERENCE_WORKERS", "").split(",") if address.strip()
+]
+INFERENCE_HEALTH_INTERVAL_SECONDS = 5
+INFERENCE_HEALTH_TIMEOUT_SECONDS = 3
+
+# --- Moderation Scheduler ---
+# handle_media only admits media into the scheduler; MODERATION_WORKERS tasks
+# moderate it. Queued media is served by priority (groups where the bot is
+# admin, then other groups, then private-chat reports) and round-robin across
+# chats within a priority, so one flooding chat cannot delay all others.
+# Media of one chat is downloaded and analyzed concurrently; its deletions and
+# notices are still taken in the order the media arrived.
+# Enough workers to fill inference micro-batches while others download
+MODERATION_WORKERS = INFERENCE_MAX_BATCH_SIZE * 2
+# Global bound on queued media. When full, media of a lower priority is shed
+# to make room, otherwise the new media is dropped.
+MODERATION_QUEUE_SIZE = 256
+MODERATION_CHAT_QUEUE_SIZE = 32
+# With this many queued items the scheduler is overloaded and degrades:
+#   "single_frame"  - videos and GIFs are judged by one frame
+#   "cascade_only"  - the CPU pre-classifier decides without the VLM
+#   "defer_private" - private-chat reports wait outside the queue until load drops
+MODERATION_OVERLOAD_THRESHOLD = 64
+MODERATION_DEGRADATION = ["single_frame", "defer_private"]
+MODERATION_DEFERRED_SIZE = 256
+# On shutdown, queued media is dropped and running jobs get this long to finish
+MODERATION_STOP_SECONDS = 10
+
+
+# --- Update Delivery ---
+# "polling", or "webhook" to receive updates on an embedded HTTP server
+# (needs python-telegram-bot[webhooks]). WEBHOOK_URL is the public HTTPS URL
+# Telegram posts to, e.g. a reverse proxy forwarding to WEBHOOK_LISTEN:WEBHOOK_PORT.
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = get_int_env("WEBHOOK_PORT") or 8443
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Updates processed concurrently. Updates of one chat are still handled one
+# after another, in order.
+UPDATE_CONCURRENCY = MODERATION_WORKERS
+
+# --- Video Analysis ---
+# Videos, GIFs and video stickers are decoded by ffmpeg straight from memory.
+#   "uniform" - VIDEO_MAX_FRAMES frames spread evenly over the clip
+#   "scene"   - the first frame plus scene changes, up to VIDEO_MAX_FRAMES
+VIDEO_SAMPLING = "uniform"
+VIDEO_MAX_FRAMES = 4
+VIDEO_SCENE_THRESHOLD = 0.3
+# Only the first VIDEO_MAX_SECONDS are decoded. VIDEO_DEFAULT_SECONDS is assumed
+# when Telegram reports no duration (e.g. video stickers).
+VIDEO_MAX_SECONDS = 30
+VIDEO_DEFAULT_SECONDS = 3
+# Frames are scaled to the model input size by ffmpeg
+VIDEO_FRAME_SIZE = MODEL_INPUT_SIZE
+# Above this resolution (width * height) only keyframes are decoded
+VIDEO_MAX_DECODE_PIXELS = 1280 * 720
+VIDEO_DECODE_TIMEOUT_SECONDS = 30
+# How frame verdicts are combined: "any", "majority" or "mean"
+VIDEO_FRAME_AGGREGATION = "any"
+
 
 # --- Caching ---
-CACHE_MAX_SIZE = 1000
\ No newline at end of file
+# Verdicts are cached per file_unique_id. The memory tier is a bounded LRU/TTL
+# cache, the persistent tier lives in the `verdict_cache` table of bot_data.db.
+CACHE_MAX_SIZE = 1000
+CACHE_TTL_SECONDS = 6 * 60 * 60
+
+# --- Near-Duplicate Detection ---
+# Re-encoded, resized or slightly cropped re-uploads are matched by the Hamming
+# distance between 64-bit perceptual hashes (0 = identical, 64 = unrelated).
+PHASH_MAX_DISTANCE = 6
+
+# --- Metrics ---
+# Per-stage latency histograms, outcome counters and queue gauges are served in
+# Prometheus text format on a local HTTP endpoint (http://host:port/metrics).
+METRICS_ENABLED = True
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = get_int_env("METRICS_PORT") or 9464
+# Log one DEBUG line per media item with the time spent in each stage
+METRICS_TRACE_LOG = True
+
+
+# --- Audit Log ---
+# Every judged media item is appended to the verdict_log table (scores, model,
+# stage timings and the action taken), through the batched database writer.
+AUDIT_ENABLED = True
+# Deletions, errors and admin decisions are summed up in one digest message to
+# LOG_CHANNEL_ID at most this often, instead of one message per event.
+AUDIT_DIGEST_INTERVAL_SECONDS = 300
+AUDIT_DIGEST_MAX_LINES = 20
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 
@@ -7,13 +8,20 @@ from telegram.ext import (
     ChatMemberHandler,
     MessageHandler,
     CallbackQueryHandler,
-    PicklePersistence,
     filters,
 )
 
 import config
 from bot.utils import database as db
 from bot.utils import ai_models
+from bot.utils import audit
+from bot.utils import metrics
+from bot.utils import outbox
+from bot.utils import phash
+from bot.utils import remote_inference
+from bot.utils import scheduler
+from bot.utils.persistence import SQLitePersistence
+from bot.utils.update_processor import ChatOrderedUpdateProcessor
 from bot.handlers import core_handlers, media_handler
 from bot.handlers import callback_handlers
 
@@ -30,33 +38,90 @@ logging.getLogger("bot.utils.ai_models").setLevel(logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
+_stop_task: asyncio.Task | None = None
+
+
+async def _stop_running(application: Application) -> None:
+    """Stops the bot, waiting for it to be running first (a load may fail during startup)."""
+    while not application.running:
+        await asyncio.sleep(0.1)
+    application.stop_running()
+
+
+def _on_failed_load(application: Application, loop: asyncio.AbstractEventLoop) -> None:
+    """Called on the loader thread if the models fail to load: the bot exits instead of answering errors."""
+    def stop():
+        global _stop_task
+        _stop_task = asyncio.create_task(_stop_running(application))
+
+    loop.call_soon_threadsafe(stop)
+
+
+async def post_init(application: Application) -> None:
+    """Starts the moderation scheduler, the outbox, the audit digest (and remote worker health checks) once the event loop is running."""
+    if remote_inference.is_enabled():
+        remote_inference.start()
+    else:
+        # Models load in the background; media is queued until they are ready
+        logger.info("Loading AI models in the background...")
+        loop = asyncio.get_running_loop()
+        ai_models.start_loading(on_failure=lambda: _on_failed_load(application, loop))
+    outbox.start(application.bot)
+    audit.start(application.bot)
+    scheduler.start()
+
+
+async def post_stop(application: Application) -> None:
+    """
+    Finishes running moderation jobs, sends the pending deletions and notices
+    and a last digest, while the bot can still make requests.
+    """
+    await scheduler.stop()
+    await outbox.stop()
+    await audit.stop()
+
+
+async def post_shutdown(application: Application) -> None:
+    """Closes remote worker connections."""
+    await remote_inference.stop()
+
 
 def main() -> None:
     """Start the bot."""
     if not config.TELEGRAM_BOT_TOKEN:
         logger.critical("TELEGRAM_BOT_TOKEN not found. Please set it in .env file.")
         return
+    if config.UPDATE_MODE == "webhook" and not config.WEBHOOK_URL:
+        logger.critical("UPDATE_MODE is webhook but WEBHOOK_URL is not set in .env file.")
+        return
 
     os.makedirs(config.DATA_PATH, exist_ok=True)
     os.makedirs(config.LOCAL_MODELS_BASE_DIR, exist_ok=True)
     
     db.init_db()
+    phash.load_index()
+    metrics.start_server()
 
-    logger.info("Loading AI models...")
-    ai_models.load_models()
-    logger.info("AI models loaded.")
+    if remote_inference.is_enabled():
+        logger.info(f"Inference runs in workers: {', '.join(config.INFERENCE_WORKERS)}")
 
-    persistence = PicklePersistence(filepath=config.PERSISTENCE_PATH)
+    persistence = SQLitePersistence()
     
     application = (
         Application.builder()
         .token(config.TELEGRAM_BOT_TOKEN)
         .persistence(persistence)
+        .concurrent_updates(ChatOrderedUpdateProcessor(config.UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
     # --- Register Handlers ---
     application.add_handler(CommandHandler("start", core_handlers.start))
+    application.add_handler(CommandHandler("stats", core_handlers.stats))
+    application.add_handler(CommandHandler("policy", core_handlers.policy))
     application.add_handler(
         ChatMemberHandler(
             core_handlers.handle_chat_member, ChatMemberHandler.MY_CHAT_MEMBER
@@ -76,8 +141,21 @@ def main() -> None:
 
 
     # --- Start Bot ---
-    logger.info("Starting bot...")
-    application.run_polling()
+    if config.UPDATE_MODE == "webhook":
+        logger.info(f"Starting bot with a webhook on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}...")
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=config.WEBHOOK_URL,
+            secret_token=config.WEBHOOK_SECRET_TOKEN,
+        )
+    else:
+        logger.info("Starting bot with polling...")
+        application.run_polling()
+    db.close_db()
+    if ai_models.readiness()["state"] == "failed":
+        raise SystemExit("Essential models failed to load. Exiting.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# Go up one level to import config from the root directory
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import config
+from telegram.constants import ChatType
+
+from bot.handlers import media_handler
+from bot.utils import ai_models
+from bot.utils import database as db
+from bot.utils import outbox
+from bot.utils import phash
+from bot.utils import preprocess
+from bot.utils import scheduler
+from bot.utils import verdict_cache
+from bot.utils import video_frames
+
+# --- Logging Setup ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.WARNING,
+)
+logger = logging.getLogger(__name__)
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+STICKER_EXTENSIONS = (".webp",)
+ANIMATION_EXTENSIONS = (".gif",)
+VIDEO_EXTENSIONS = (".mp4", ".webm", ".mov", ".mkv")
+
+
+class StageRecorder:
+    """Collects per-stage latencies from the event loop and the inference thread."""
+
+    def __init__(self):
+        self._samples: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, module, name: str, stage: str):
+        """Replaces module.name with a version that records its duration."""
+        original = getattr(module, name)
+
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+
+        setattr(module, name, timed)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Returns count, mean and p50/p95/p99 (milliseconds) per stage."""
+        def percentile(values: list[float], q: float) -> float:
+            index = min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))
+            return values[index] * 1000
+
+        report = {}
+        with self._lock:
+            for stage, samples in sorted(self._samples.items()):
+                values = sorted(samples)
+                report[stage] = {
+                    "count": len(values),
+                    "mean_ms": sum(values) / len(values) * 1000,
+                    "p50_ms": percentile(values, 50),
+                    "p95_ms": percentile(values, 95),
+                    "p99_ms": percentile(values, 99),
+                }
+        return report
+
+
+# --- Fake Telegram objects: just enough of Update/Message/Bot for handle_media ---
+
+class FakeFile:
+    def __init__(self, content: bytes):
+        self.file_size = len(content)
+        self._content = content
+
+    async def download_to_memory(self, out: io.BytesIO):
+        out.write(self._content)
+
+
+class FakeBot:
+    """Serves corpus files by file_id and counts outbound calls instead of sending them."""
+
+    def __init__(self, files: dict[str, bytes]):
+        self.id = 1
+        self.files = files
+        self.calls: dict[str, int] = {}
+        self._next_message_id = 1
+
+    def _count(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    async def get_file(self, file_id: str) -> FakeFile:
+        self._count("get_file")
+        return FakeFile(self.files[file_id])
+
+    async def get_chat_member(self, *args, **kwargs):
+        self._count("get_chat_member")
+        return SimpleNamespace(status="administrator")
+
+    async def send_chat_action(self, *args, **kwargs):
+        self._count("send_chat_action")
+
+    async def send_message(self, *args, **kwargs):
+        self._count("send_message")
+        self._next_message_id += 1
+        return SimpleNamespace(message_id=self._next_message_id)
+
+    async def delete_message(self, *args, **kwargs):
+        self._count("delete_message")
+
+    async def delete_messages(self, *args, **kwargs):
+        self._count("delete_messages")
+
+    async def edit_message_text(self, *args, **kwargs):
+        self._count("edit_message_text")
+
+
+def _media_object(file_id: str, file_unique_id: str, size: int, width: int = 512, height: int = 512):
+    return SimpleNamespace(
+        file_id=file_id,
+        file_unique_id=file_unique_id,
+        file_size=size,
+        width=width,
+        height=height,
+        duration=None,
+        thumbnail=None,
+        is_video=False,
+        is_animated=False,
+    )
+
+
+def build_update(
+    path: str, content: bytes, file_unique_id: str, chat_type: str, bot: FakeBot, media_group_id: str | None = None
+):
+    """Builds a fake Update carrying one corpus file as the matching media type."""
+    file_id = f"file-{file_unique_id}"
+    bot.files[file_id] = content
+    media = _media_object(file_id, file_unique_id, len(content))
+    extension = os.path.splitext(path)[1].lower()
+
+    async def noop(*args, **kwargs):
+        bot._count("message_call")
+
+    message = SimpleNamespace(
+        photo=[], sticker=None, animation=None, video=None,
+        media_group_id=media_group_id, message_id=random.randint(1, 10**9),
+        delete=noop, reply_html=noop,
+    )
+    if extension in PHOTO_EXTENSIONS:
+        message.photo = [media]
+    elif extension in STICKER_EXTENSIONS:
+        message.sticker = media
+    elif extension in ANIMATION_EXTENSIONS:
+        message.animation = media
+    else:
+        media.is_video = True
+        message.video = media
+
+    chat = SimpleNamespace(id=-1000 if chat_type != ChatType.PRIVATE else 1000, type=chat_type, title="bench")
+    user = SimpleNamespace(id=42, username="bench", mention_html=lambda: "bench")
+    return SimpleNamespace(effective_message=message, effective_chat=chat, effective_user=user)
+
+
+def load_corpus(corpus_dir: str) -> list[tuple[str, bytes]]:
+    """Reads every supported media file below the corpus directory."""
+    extensions = PHOTO_EXTENSIONS + STICKER_EXTENSIONS + ANIMATION_EXTENSIONS + VIDEO_EXTENSIONS
+    corpus = []
+    for root, _, names in os.walk(corpus_dir):
+        for name in sorted(names):
+            if name.lower().endswith(extensions):
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    corpus.append((path, f.read()))
+    return corpus
+
+
+def install_stub_model(latency_ms: float):
+    """Replaces the VLM with a stub that sleeps per image and returns random scores."""
+    def stub_analyze_batch(image_contents, early_exit=None, cascade_only=None, policies=None):
+        time.sleep(latency_ms / 1000 * len(image_contents))
+        results = []
+        for image_policies in policies or [None] * len(image_contents):
+            thresholds = image_policies or config.POLICY_THRESHOLDS
+            scores = {key: random.random() * 0.6 for key in thresholds}
+            result = {key: score >= thresholds[key] for key, score in scores.items()}
+            result["scores"] = scores
+            result["general_nsfw_score"] = scores.get("is_nsfw", 0.0)
+            result["gore_violence_score"] = scores.get("is_violence", 0.0)
+            results.append(result)
+        return results
+
+    ai_models.analyze_batch = stub_analyze_batch
+    ai_models.start_inference_worker()
+    ai_models._readiness["load_seconds"] = 0.0
+    ai_models._set_ready(True)
+
+
+def instrument(recorder: StageRecorder, real_model: bool):
+    """Wraps every pipeline stage handle_media goes through with a timer."""
+    recorder.wrap(db, "check_media_exception", "db_exception_check")
+    recorder.wrap(verdict_cache, "get_verdict", "verdict_cache_lookup")
+    recorder.wrap(media_handler, "_moderate_media", "moderation")
+    recorder.wrap(media_handler, "_download_media", "download_and_decode")
+    recorder.wrap(video_frames, "extract_frames", "frame_extraction")
+    recorder.wrap(phash, "compute_hash", "phash")
+    recorder.wrap(preprocess, "prepare_many", "preprocess")
+    recorder.wrap(ai_models, "analyze_many_async", "inference_request")
+    recorder.wrap(ai_models, "analyze_batch", "inference_batch")
+    if real_model:
+        recorder.wrap(ai_models, "_encode_images", "vision_encoder")
+        recorder.wrap(ai_models, "_score_rows", "policy_scoring")
+        recorder.wrap(ai_models, "_generate_rows", "policy_generation")
+
+
+async def replay(corpus, args, recorder: StageRecorder) -> tuple[int, float, dict[str, int]]:
+    """
+    Feeds the corpus to handle_media, --concurrency updates at a time, and waits
+    for the moderation scheduler to finish every admitted item.
+    """
+    bot = FakeBot({})
+    context = SimpleNamespace(bot=bot, application=SimpleNamespace(create_task=asyncio.create_task))
+    chat_type = ChatType.PRIVATE if args.private else ChatType.SUPERGROUP
+    semaphore = asyncio.Semaphore(args.concurrency)
+    scheduler.start()
+    outbox.start(bot)
+
+    async def run_one(iteration: int, index: int, path: str, content: bytes):
+        # A fresh file_unique_id per iteration, so repeats are not verdict cache hits
+        file_unique_id = f"{hashlib.sha1(content).hexdigest()[:16]}-{iteration}"
+        media_group_id = f"{iteration}-{index // args.album_size}" if args.album_size > 1 else None
+        update = build_update(path, content, file_unique_id, chat_type, bot, media_group_id)
+        async with semaphore:
+            started = time.perf_counter()
+            await media_handler.handle_media(update, context)
+            recorder.record("admission", time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_one(iteration, index, path, content)
+        for iteration in range(args.repeat)
+        for index, (path, content) in enumerate(corpus)
+    ))
+    while media_handler._albums:
+        # Albums still being collected have not reached the scheduler yet
+        await asyncio.sleep(0.01)
+    await scheduler.drain()
+    await scheduler.stop()
+    await outbox.drain()
+    await outbox.stop()
+    return len(corpus) * args.repeat, time.perf_counter() - started, bot.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays a local media corpus through the moderation pipeline and reports latencies."
+    )
+    parser.add_argument("corpus_dir", help="Directory of photos, .webp stickers, GIFs and videos")
+    parser.add_argument("--stub-model", action="store_true", help="Use a stub instead of the VLM weights")
+    parser.add_argument("--stub-latency-ms", type=float, default=50.0, help="Stub inference time per image")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the corpus this many times")
+    parser.add_argument("--concurrency", type=int, default=1, help="Updates fed to handle_media concurrently")
+    parser.add_argument("--workers", type=int, default=config.MODERATION_WORKERS, help="Moderation scheduler workers")
+    parser.add_argument("--album-size", type=int, default=1, help="Send the corpus as albums of this many items")
+    parser.add_argument("--private", action="store_true", help="Replay as private-chat reports instead of group media")
+    parser.add_argument("--reuse-verdicts", action="store_true", help="Allow near-duplicate verdict reuse")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    config.MODERATION_WORKERS = args.workers
+    corpus = load_corpus(args.corpus_dir)
+    if not corpus:
+        raise SystemExit(f"No media found in {args.corpus_dir}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Never touch the production database
+        db.DATABASE_PATH = os.path.join(temp_dir, "bench.db")
+        db.init_db()
+
+        if args.stub_model:
+            install_stub_model(args.stub_latency_ms)
+        else:
+            ai_models.load_models()
+        if not args.reuse_verdicts:
+            phash.find_verdict = lambda image_hash: None
+
+        recorder = StageRecorder()
+        instrument(recorder, real_model=not args.stub_model)
+        items, seconds, calls = asyncio.run(replay(corpus, args, recorder))
+        db.close_db()
+
+    report = {
+        "items": items,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds else None,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "model": "stub" if args.stub_model else f"{config.HF_MODEL_ID} ({config.INFERENCE_BACKEND})",
+        "telegram_calls": calls,
+        "stages": recorder.summary(),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import time
+
+# Go up one level to import config from the root directory
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import config
+from bot.utils import ai_models
+
+# --- Logging Setup ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def load_image_set(image_dir: str) -> list[tuple[str, bytes]]:
+    """Reads every image of the fixed evaluation set, sorted by name."""
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(image_dir, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+
+def run_backend(backend: str, images: list[tuple[str, bytes]]) -> tuple[list[dict], float]:
+    """Loads the model with one backend and analyzes the whole set, one image at a time."""
+    ai_models.model = None
+    gc.collect()
+
+    load_started = time.perf_counter()
+    ai_models.load_models(backend)
+    logger.info(f"[{backend}] loaded in {time.perf_counter() - load_started:.1f}s")
+
+    started = time.perf_counter()
+    results = [ai_models.analyze_image(content) for _, content in images]
+    return results, time.perf_counter() - started
+
+
+def compare(reference: list[dict], candidate: list[dict]) -> dict:
+    """Computes per-policy score deltas and flag agreement against the reference backend."""
+    report = {}
+    for key in config.DETECTION_POLICIES:
+        deltas, agreements = [], []
+        for ref, cand in zip(reference, candidate):
+            if "error" in ref or "error" in cand:
+                continue
+            deltas.append(abs(ref["scores"][key] - cand["scores"][key]))
+            agreements.append(ref[key] == cand[key])
+        report[key] = {
+            "mean_abs_delta": sum(deltas) / len(deltas) if deltas else None,
+            "max_abs_delta": max(deltas, default=None),
+            "flag_agreement": sum(agreements) / len(agreements) if agreements else None,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares inference backends for speed and accuracy on a fixed image set."
+    )
+    parser.add_argument("image_dir", help="Directory with the fixed evaluation images")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=list(ai_models.BACKEND_DTYPES),
+        choices=list(ai_models.BACKEND_DTYPES),
+        help="Backends to compare (default: all)",
+    )
+    parser.add_argument("--reference", default="fp32", help="Backend the others are compared to")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    images = load_image_set(args.image_dir)
+    if not images:
+        raise SystemExit(f"No images found in {args.image_dir}")
+
+    # Full evaluation of every image: no cascade shortcuts, no early exit
+    config.CASCADE_ENABLED = False
+    config.ANALYSIS_MODE = "score"
+
+    backends = [args.reference] + [b for b in args.backends if b != args.reference]
+    runs = {backend: run_backend(backend, images) for backend in backends}
+    reference_results = runs[args.reference][0]
+
+    report = {"images": len(images), "reference": args.reference, "backends": {}}
+    for backend, (results, seconds) in runs.items():
+        report["backends"][backend] = {
+            "seconds": seconds,
+            "images_per_second": len(images) / seconds if seconds else None,
+            "errors": sum("error" in result for result in results),
+            "policies": compare(reference_results, results),
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
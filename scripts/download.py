@@ -1,11 +1,18 @@
+import argparse
 import os
 import logging
-from transformers import AutoProcessor, PaliGemmaForConditionalGeneration
+from transformers import (
+    AutoImageProcessor,
+    AutoModelForImageClassification,
+    AutoProcessor,
+    PaliGemmaForConditionalGeneration,
+)
 
 # Go up one level to import config from the root directory
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import config
+from bot.utils import ai_models
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -44,6 +51,77 @@ def download_main_model():
     logger.info("--- Model download process finished. ---")
 
 
+def download_cascade_model():
+    """Downloads and saves the cascade pre-classifier and its image processor."""
+
+    model_id = config.CASCADE_MODEL_ID
+    local_path = os.path.join(config.LOCAL_MODELS_BASE_DIR, model_id.replace("/", "_"))
+
+    logger.info(f"--- Downloading cascade pre-classifier: {model_id} ---")
+
+    if os.path.exists(local_path) and os.listdir(local_path):
+        logger.info(f"'{model_id}' already exists locally. Skipping.")
+    else:
+        try:
+            os.makedirs(local_path, exist_ok=True)
+            image_processor = AutoImageProcessor.from_pretrained(model_id)
+            model = AutoModelForImageClassification.from_pretrained(model_id)
+
+            image_processor.save_pretrained(local_path)
+            model.save_pretrained(local_path)
+            logger.info(f"Successfully downloaded and saved '{model_id}' to '{local_path}'")
+        except Exception as e:
+            logger.critical(f"Failed to download {model_id}. Error: {e}", exc_info=True)
+
+    logger.info("--- Cascade download process finished. ---")
+
+
+def build_snapshot(backend: str):
+    """
+    Writes a load-optimized snapshot of the downloaded VLM for one inference backend:
+    safetensors shards already in the backend's weight dtype, plus the processor config.
+    The bot memory-maps it at startup instead of converting the original checkpoint.
+    """
+
+    source_path = ai_models.model_path()
+    snapshot_path = ai_models.snapshot_path(backend)
+    dtype = ai_models.BACKEND_DTYPES[backend]
+
+    logger.info(f"--- Building {dtype} snapshot for backend '{backend}' ---")
+
+    if not os.path.exists(source_path) or not os.listdir(source_path):
+        logger.critical(f"Model not found at {source_path}. Download it first.")
+        return
+
+    try:
+        processor = AutoProcessor.from_pretrained(source_path)
+        model = PaliGemmaForConditionalGeneration.from_pretrained(
+            source_path, torch_dtype=dtype, low_cpu_mem_usage=True
+        )
+
+        os.makedirs(snapshot_path, exist_ok=True)
+        processor.save_pretrained(snapshot_path)
+        model.save_pretrained(snapshot_path, safe_serialization=True, max_shard_size="2GB")
+        logger.info(f"Successfully saved snapshot to '{snapshot_path}'")
+    except Exception as e:
+        logger.critical(f"Failed to build snapshot. Error: {e}", exc_info=True)
+
+
 if __name__ == "__main__":
     import torch # Add torch import for the script to run standalone
-    download_main_model()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Downloads the models used by the bot.")
+    parser.add_argument(
+        "--snapshot",
+        nargs="?",
+        const=config.INFERENCE_BACKEND,
+        choices=list(ai_models.BACKEND_DTYPES),
+        help="Also build a load-optimized snapshot for this backend (default: INFERENCE_BACKEND)",
+    )
+    args = parser.parse_args()
+
+    download_main_model()
+    if config.CASCADE_ENABLED:
+        download_cascade_model()
+    if args.snapshot:
+        build_snapshot(args.snapshot)
\ No newline at end of file
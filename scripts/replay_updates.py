@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import httpx
+
+# Go up one level to import config from the root directory
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import config
+
+# --- Logging Setup ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def load_updates(paths: list[str]) -> list[dict]:
+    """
+    Reads recorded updates from .json files (one update, a list of updates or a
+    raw getUpdates response) and .jsonl files (one update per line).
+    Directories are searched recursively.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if name.endswith((".json", ".jsonl"))
+                )
+        else:
+            files.append(path)
+
+    updates = []
+    for path in files:
+        with open(path) as f:
+            if path.endswith(".jsonl"):
+                updates.extend(json.loads(line) for line in f if line.strip())
+                continue
+            data = json.load(f)
+        if isinstance(data, dict) and "result" in data:
+            data = data["result"]
+        updates.extend(data if isinstance(data, list) else [data])
+    return updates
+
+
+async def replay(updates: list[dict], args) -> tuple[dict[int, int], list[float]]:
+    """POSTs the updates to the webhook, --concurrency at a time, in their recorded order."""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    statuses: dict[int, int] = {}
+    latencies: list[float] = []
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(index: int, update: dict):
+            if args.renumber:
+                update = dict(update, update_id=args.first_update_id + index)
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(args.url, json=update, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    logger.error(f"Update {update.get('update_id')} failed: {e}")
+                    status = 0
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        await asyncio.gather(*(
+            post(index, update)
+            for index, update in enumerate(updates * args.repeat)
+        ))
+    return statuses, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays recorded Telegram updates against the bot's local webhook server."
+    )
+    parser.add_argument("paths", nargs="+", help="Update .json/.jsonl files or directories")
+    parser.add_argument(
+        "--url",
+        default=f"http://{config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH}",
+        help="Webhook endpoint (default: the configured listen address)",
+    )
+    parser.add_argument("--secret", default=config.WEBHOOK_SECRET_TOKEN, help="Webhook secret token")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the updates this many times")
+    parser.add_argument("--renumber", action="store_true", help="Give every update a fresh update_id")
+    parser.add_argument("--first-update-id", type=int, default=int(time.time()), help="First id for --renumber")
+    args = parser.parse_args()
+
+    updates = load_updates(args.paths)
+    if not updates:
+        raise SystemExit("No updates found")
+
+    logger.info(f"Posting {len(updates) * args.repeat} updates to {args.url}...")
+    started = time.perf_counter()
+    statuses, latencies = asyncio.run(replay(updates, args))
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    report = {
+        "updates": len(latencies),
+        "seconds": seconds,
+        "updates_per_second": len(latencies) / seconds if seconds else None,
+        "statuses": statuses,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
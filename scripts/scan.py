@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any
+
+from PIL import Image
+
+# Go up one level to import config from the root directory
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import config
+from bot.utils import preprocess
+from bot.utils import video_frames
+
+# --- Logging Setup ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+VIDEO_EXTENSIONS = (".gif", ".mp4", ".webm", ".mov", ".mkv")
+
+
+# --- Inputs ---
+
+def _item(item_id: str, path: str, duration: float | None = None, **extra: Any) -> dict[str, Any] | None:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        kind = "image"
+    elif extension in VIDEO_EXTENSIONS:
+        kind = "video"
+    else:
+        return None
+    return {"item": item_id, "path": path, "kind": kind, "duration": duration, **extra}
+
+
+def load_directory(root_dir: str, video_seconds: float) -> list[dict[str, Any]]:
+    """
+    Lists every supported media file below a directory. Video durations are
+    read from the files when they are decoded; `video_seconds` is assumed for
+    those without one.
+    """
+    items = []
+    for root, _, names in os.walk(root_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            item = _item(os.path.relpath(path, root_dir), path, default_duration=video_seconds)
+            if item:
+                items.append(item)
+    return items
+
+
+def load_export(result_path: str) -> list[dict[str, Any]]:
+    """
+    Lists the media of a Telegram Desktop export (result.json of one chat or of
+    a full account export). Animated stickers are judged by their thumbnail.
+    """
+    base_dir = os.path.dirname(os.path.abspath(result_path))
+    with open(result_path, encoding="utf-8") as f:
+        data = json.load(f)
+    chats = data["chats"]["list"] if "chats" in data else [data]
+
+    items = []
+    for chat in chats:
+        for message in chat.get("messages", []):
+            media_path = message.get("photo") or message.get("file")
+            if media_path and media_path.endswith(".tgs"):
+                media_path = message.get("thumbnail")
+            if not media_path or media_path.startswith("(File not included"):
+                continue
+            item = _item(
+                f"{chat.get('id')}/{message['id']}",
+                os.path.join(base_dir, media_path),
+                message.get("duration_seconds"),
+                chat_id=chat.get("id"),
+                message_id=message["id"],
+                date=message.get("date"),
+            )
+            if item:
+                items.append(item)
+    return items
+
+
+# --- Decoding (runs in the process pool) ---
+
+async def _extract_video(item: dict[str, Any]) -> list[Image.Image]:
+    """Samples a video's frames over its duration, probing the file if the duration is unknown."""
+    duration = item["duration"]
+    if not duration:
+        duration = await video_frames.probe_duration(item["path"]) or item.get("default_duration")
+    return await video_frames.extract_frames_from_file(item["path"], duration)
+
+
+def prepare_item(item: dict[str, Any]) -> tuple[str, list[tuple[tuple[int, int], bytes]], str | None]:
+    """Decodes one item into model-sized RGB frames, returned as raw bytes."""
+    try:
+        if item["kind"] == "video":
+            frames = asyncio.run(_extract_video(item))
+        else:
+            # Same decoding and resize as the bot's preprocessing, done here off the main process
+            with open(item["path"], "rb") as f:
+                frames = [preprocess.resize(preprocess.decode(f.read()))]
+    except Exception as e:
+        return item["item"], [], f"Decoding failed: {e}"
+    if not frames:
+        return item["item"], [], "No frames decoded"
+    return item["item"], [(frame.size, frame.tobytes()) for frame in frames], None
+
+
+# --- Checkpoint ---
+
+def open_checkpoint(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scan_results (
+            item TEXT NOT NULL,
+            policy_version TEXT NOT NULL,
+            verdict TEXT NOT NULL,
+            PRIMARY KEY (item, policy_version)
+        )
+        """
+    )
+    conn.commit()
+    return conn
+
+
+def done_items(conn: sqlite3.Connection, policy_version: str) -> set[str]:
+    rows = conn.execute("SELECT item FROM scan_results WHERE policy_version = ?", (policy_version,))
+    return {item for item, in rows}
+
+
+# --- Scanning ---
+
+def scan(items: list[dict[str, Any]], args, conn: sqlite3.Connection, policy_version: str) -> int:
+    """
+    Decodes items in a process pool while the main process runs the model on
+    full batches of frames. Verdicts are checkpointed after every batch.
+    Returns the number of items scanned.
+    """
+    from bot.utils import ai_models
+
+    frames: list[tuple[str, Image.Image]] = []
+    frame_results: dict[str, list[dict[str, Any]]] = {}
+    expected: dict[str, int] = {}
+    scanned = 0
+    next_progress = 100
+
+    def save(rows: list[tuple[str, dict[str, Any]]]):
+        nonlocal scanned
+        conn.executemany(
+            "INSERT OR REPLACE INTO scan_results (item, policy_version, verdict) VALUES (?, ?, ?)",
+            [(item_id, policy_version, json.dumps(verdict)) for item_id, verdict in rows],
+        )
+        conn.commit()
+        scanned += len(rows)
+
+    def run_batch(batch: list[tuple[str, Image.Image]]):
+        results = ai_models.analyze_batch([frame for _, frame in batch])
+        finished = []
+        for (item_id, _), result in zip(batch, results):
+            frame_results[item_id].append(result)
+            if len(frame_results[item_id]) == expected[item_id]:
+                finished.append((item_id, video_frames.aggregate_frames(frame_results.pop(item_id))))
+        save(finished)
+
+    started = time.perf_counter()
+    # Spawned workers do not inherit the model or torch's thread pools
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        queued = iter(items)
+        running: set[Future] = set()
+        while True:
+            while len(running) < args.workers * 4:
+                item = next(queued, None)
+                if item is None:
+                    break
+                running.add(pool.submit(prepare_item, item))
+            if not running:
+                break
+
+            completed, running = wait(running, return_when=FIRST_COMPLETED)
+            errors = []
+            for future in completed:
+                item_id, item_frames, error = future.result()
+                if error:
+                    errors.append((item_id, {"error": error}))
+                    continue
+                expected[item_id] = len(item_frames)
+                frame_results[item_id] = []
+                frames.extend(
+                    (item_id, Image.frombytes("RGB", frame_size, data)) for frame_size, data in item_frames
+                )
+            if errors:
+                save(errors)
+
+            while len(frames) >= args.batch_size:
+                batch, frames = frames[:args.batch_size], frames[args.batch_size:]
+                run_batch(batch)
+
+            if scanned >= next_progress:
+                next_progress += 100
+                rate = scanned / (time.perf_counter() - started)
+                logger.info(f"Scanned {scanned}/{len(items)} items ({rate:.1f}/s)")
+
+    if frames:
+        run_batch(frames)
+    return scanned
+
+
+# --- Report ---
+
+def report_rows(conn: sqlite3.Connection, items: list[dict[str, Any]], policy_version: str) -> list[dict[str, Any]]:
+    """Builds one flat report row per item, in input order."""
+    verdicts = {
+        item_id: json.loads(verdict)
+        for item_id, verdict in conn.execute(
+            "SELECT item, verdict FROM scan_results WHERE policy_version = ?", (policy_version,)
+        )
+    }
+    rows = []
+    for item in items:
+        verdict = verdicts.get(item["item"])
+        if verdict is None:
+            continue
+        row = {
+            "item": item["item"],
+            "path": item["path"],
+            "chat_id": item.get("chat_id"),
+            "message_id": item.get("message_id"),
+            "date": item.get("date"),
+            "kind": item["kind"],
+            "flagged": any(verdict.get(key, False) for key in config.DETECTION_POLICIES),
+            "frames": verdict.get("frames", 1),
+            "decided_by": verdict.get("decided_by", "vlm"),
+            "error": verdict.get("error"),
+        }
+        for key in config.DETECTION_POLICIES:
+            row[key] = verdict.get(key)
+            row[f"{key}_score"] = verdict.get("scores", {}).get(key)
+        rows.append(row)
+    return rows
+
+
+def write_report(rows: list[dict[str, Any]], output: str):
+    """Writes the report as CSV, Parquet or SQLite, by file extension."""
+    extension = os.path.splitext(output)[1].lower()
+    if extension == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet reports need pyarrow: pip install pyarrow")
+        pq.write_table(pa.Table.from_pylist(rows), output)
+    elif extension in (".db", ".sqlite", ".sqlite3"):
+        columns = list(rows[0]) if rows else ["item"]
+        with sqlite3.connect(output) as conn:
+            conn.execute("DROP TABLE IF EXISTS report")
+            conn.execute(f"CREATE TABLE report ({', '.join(columns)})")
+            conn.executemany(
+                f"INSERT INTO report VALUES ({', '.join('?' for _ in columns)})",
+                [tuple(row.values()) for row in rows],
+            )
+    else:
+        with open(output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["item"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Scans a media folder or a Telegram export (result.json) for policy violations."
+    )
+    parser.add_argument("source", help="Directory of media, or the result.json of a Telegram export")
+    parser.add_argument("output", help="Report file: .csv, .parquet (needs pyarrow) or .db/.sqlite")
+    parser.add_argument("--checkpoint", help="Checkpoint database (default: <output>.checkpoint.db)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Decoding processes")
+    parser.add_argument("--batch-size", type=int, default=config.INFERENCE_MAX_BATCH_SIZE * 2, help="Frames per model batch")
+    parser.add_argument(
+        "--video-seconds",
+        type=float,
+        default=config.VIDEO_MAX_SECONDS,
+        help="Length assumed for videos in a directory whose duration cannot be read from the file",
+    )
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        items = load_directory(args.source, args.video_seconds)
+    else:
+        items = load_export(args.source)
+    if not items:
+        raise SystemExit(f"No media found in {args.source}")
+
+    # Imported here so the spawned decoding processes never import torch
+    from bot.utils import ai_models
+    from bot.utils import verdict_cache
+
+    policy_version = verdict_cache.policy_version()
+    conn = open_checkpoint(args.checkpoint or f"{args.output}.checkpoint.db")
+    done = done_items(conn, policy_version)
+    pending = [item for item in items if item["item"] not in done]
+    logger.info(f"{len(items)} items found, {len(done)} already scanned, {len(pending)} to go")
+
+    if pending:
+        ai_models.load_models()
+        started = time.perf_counter()
+        scanned = scan(pending, args, conn, policy_version)
+        seconds = time.perf_counter() - started
+        logger.info(f"Scanned {scanned} items in {seconds:.1f}s ({scanned / seconds:.1f} items/s)")
+
+    rows = report_rows(conn, items, policy_version)
+    conn.close()
+    write_report(rows, args.output)
+    flagged = sum(row["flagged"] for row in rows)
+    logger.info(f"Report written to {args.output}: {len(rows)} items, {flagged} flagged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+import logging
+import os
+
+import config
+from bot.utils import remote_inference
+
+# --- Logging Setup ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """Start an inference worker for a bot running with INFERENCE_WORKERS."""
+    parser = argparse.ArgumentParser(
+        description="Loads the model and serves inference requests from the bot front end."
+    )
+    parser.add_argument(
+        "--listen",
+        required=True,
+        help='Address to listen on: "unix:/path/to.sock" or "host:port"',
+    )
+    args = parser.parse_args()
+
+    os.makedirs(config.LOCAL_MODELS_BASE_DIR, exist_ok=True)
+    try:
+        asyncio.run(remote_inference.serve(args.listen))
+    except KeyboardInterrupt:
+        logger.info("Inference worker stopped.")
+
+
+if __name__ == "__main__":
+    main()